@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Static asset pipeline for the web app.
+#
+# Only the assets listed in ASSETS are served. At startup every asset is read once, references between assets
+# (url(...) in css) are rewritten, and the result is stored under a content-hashed file name together with
+# precompressed gzip and (if the brotli module is available) brotli variants. Because the name changes whenever
+# the content does, clients can cache the assets forever.
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# dependencies go first, so that the files referring to them can be rewritten
+ASSETS = [
+    "images/sort_both.png",
+    "images/sort_asc.png",
+    "images/sort_desc.png",
+    "images/sort_asc_disabled.png",
+    "images/sort_desc_disabled.png",
+    "jquery-3.7.1.min.js",
+    "popper.min.js",
+    "js/bootstrap.min.js",
+    "js/jquery.dataTables.min.js",
+    "css/bootstrap.min.css",
+    "css/jquery.dataTables.min.css",
+]
+
+COMPRESSIBLE = ("text/css", "text/javascript", "application/javascript", "image/svg+xml")
+MAX_AGE = 365 * 24 * 3600
+
+CSS_URL = re.compile(r"""url\((["']?)([^"')]+)\1\)""")
+SOURCE_MAP = re.compile(rb"/[*/]# sourceMappingURL=[^\n]*?(\*/)?\s*$")
+
+
+class Asset:
+    def __init__(self, name: str, content: bytes):
+        self.name = name
+        self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.digest = hashlib.sha256(content).hexdigest()[:12]
+
+        base, ext = posixpath.splitext(name)
+        self.filename = "{}.{}{}".format(base, self.digest, ext)
+
+        # precompressed variants, by content-encoding
+        self.variants = {"identity": content}
+        if self.mimetype in COMPRESSIBLE:
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(content, quality=11)
+                if len(compressed) < len(content):
+                    self.variants["br"] = compressed
+
+
+class AssetPipeline:
+    def __init__(self, app: flask.Flask = None, directory="static", assets=ASSETS, url_prefix="/assets"):
+        self.logger = logging.getLogger(__name__)
+        self.directory = Path(directory)
+        self.url_prefix = url_prefix
+        self._by_name = dict()
+        self._by_filename = dict()
+
+        for name in assets:
+            self._add(name)
+
+        if app is not None:
+            self.init_app(app)
+
+    def _add(self, name: str):
+        content = (self.directory / name).read_bytes()
+        # we don't serve source maps
+        content = SOURCE_MAP.sub(b"", content)
+
+        if name.endswith(".css"):
+            content = self._rewrite_css(name, content.decode("utf-8")).encode("utf-8")
+
+        asset = Asset(name, content)
+        self._by_name[name] = asset
+        self._by_filename[asset.filename] = asset
+        self.logger.debug(
+            "asset %s -> %s (%s)",
+            name,
+            asset.filename,
+            ", ".join("{}: {}".format(k, len(v)) for k, v in asset.variants.items()),
+        )
+
+    def _rewrite_css(self, name: str, css: str) -> str:
+        def replace(match):
+            quote, url = match.groups()
+            if url.startswith("data:") or "//" in url:
+                return match.group(0)
+            ref = posixpath.normpath(posixpath.join(posixpath.dirname(name), url))
+            if ref not in self._by_name:
+                raise ValueError("Asset {} refers to {}, which is not a known asset".format(name, ref))
+            # all assets are served from the same directory level as they are stored on disk
+            target = posixpath.relpath(self._by_name[ref].filename, posixpath.dirname(name) or ".")
+            return "url({0}{1}{0})".format(quote, target)
+
+        return CSS_URL.sub(replace, css)
+
+    def url(self, name: str) -> str:
+        return flask.url_for("asset", filename=self._by_name[name].filename)
+
+    def serve(self, filename):
+        asset = self._by_filename.get(filename)
+        if asset is None:
+            flask.abort(404)
+
+        # pick the best precompressed variant the client accepts
+        encoding = "identity"
+        accepted = flask.request.accept_encodings
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and accepted[candidate]:
+                encoding = candidate
+                break
+
+        response = flask.Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        response.set_etag("{}-{}".format(asset.digest, encoding))
+        response.cache_control.public = True
+        response.cache_control.max_age = MAX_AGE
+        response.cache_control.immutable = True
+        return response.make_conditional(flask.request)
+
+    def init_app(self, app: flask.Flask):
+        app.add_url_rule(self.url_prefix + "/<path:filename>", "asset", self.serve)
+        app.add_template_global(self.url, "asset_url")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Compare the EWS and Graph calendar backends.
+#
+#   python benchmark_backends.py                 parse cost per event (EWS XML vs Graph JSON), and Graph batching
+#                                                against the local stub (see graph_stub.py)
+#   python benchmark_backends.py --config webapp.config --mailbox room1@example.org --mailbox ...
+#                                                the same agendas fetched from the real tenant with both backends
+
+import argparse
+import configparser
+import datetime
+import json
+import statistics
+import threading
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+import logging
+
+import exchangelib
+from exchangelib.util import to_xml
+from werkzeug.serving import make_server
+
+import graph_stub
+from surfagenda import EWSScheduler, SurfAgenda
+from surfagenda.backends import GRAPH_EVENT_FIELDS, EWSBackend, GraphBackend
+
+EWS_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<m:FindItemResponse xmlns:m="http://schemas.microsoft.com/exchange/services/2006/messages"
+ xmlns:t="http://schemas.microsoft.com/exchange/services/2006/types"><m:ResponseMessages>
+<m:FindItemResponseMessage ResponseClass="Success"><m:ResponseCode>NoError</m:ResponseCode>
+<m:RootFolder TotalItemsInView="{count}" IncludesLastItemInRange="true"><t:Items>
+{items}
+</t:Items></m:RootFolder></m:FindItemResponseMessage></m:ResponseMessages></m:FindItemResponse>
+</s:Body></s:Envelope>'''
+
+EWS_ITEM = '''<t:CalendarItem><t:ItemId Id={id} ChangeKey={changekey}/><t:Subject>{subject}</t:Subject>
+<t:Sensitivity>{sensitivity}</t:Sensitivity><t:TextBody BodyType="Text">{body}</t:TextBody>
+<t:Start>{start}</t:Start><t:End>{end}</t:End><t:IsAllDayEvent>{all_day}</t:IsAllDayEvent>
+<t:Location>{location}</t:Location><t:MyResponseType>{response}</t:MyResponseType>
+<t:Organizer>{organizer}</t:Organizer>
+<t:RequiredAttendees>{attendees}</t:RequiredAttendees><t:Resources>{resources}</t:Resources>
+<t:IsOnlineMeeting>{online}</t:IsOnlineMeeting></t:CalendarItem>'''
+
+EWS_RESPONSES = {
+    'none': 'Unknown',
+    'organizer': 'Organizer',
+    'tentativelyAccepted': 'Tentative',
+    'accepted': 'Accept',
+    'declined': 'Decline',
+    'notResponded': 'NoResponseReceived',
+}
+
+
+class OfflineAgenda(SurfAgenda):
+    # no tokens needed for the stub
+    def _get_msal_app(self):
+        return None
+
+    def get_token(self, scopes):
+        return {'access_token': 'stub'}
+
+
+def ews_mailbox(address):
+    return '<t:Mailbox><t:Name>{}</t:Name><t:EmailAddress>{}</t:EmailAddress><t:RoutingType>SMTP</t:RoutingType>' \
+           '</t:Mailbox>'.format(escape(address['name']), escape(address['address']))
+
+
+def ews_attendee(attendee):
+    return '<t:Attendee>{}<t:ResponseType>{}</t:ResponseType></t:Attendee>'.format(
+        ews_mailbox(attendee['emailAddress']), EWS_RESPONSES[attendee['status']['response']])
+
+
+# the same event, as EWS would have sent it
+def ews_item(event):
+    def ews_time(t):
+        return t['dateTime'][:19] + 'Z'
+
+    return EWS_ITEM.format(
+        id=quoteattr(event['id']),
+        changekey=quoteattr(event['changeKey']),
+        subject=escape(event['subject']),
+        sensitivity=event['sensitivity'].capitalize(),
+        body=escape(event['body']['content']),
+        start=ews_time(event['start']),
+        end=ews_time(event['end']),
+        all_day=str(event['isAllDay']).lower(),
+        location=escape(event['location']['displayName']),
+        response=EWS_RESPONSES[event['responseStatus']['response']],
+        organizer=ews_mailbox(event['organizer']['emailAddress']),
+        attendees=''.join(ews_attendee(a) for a in event['attendees'] if a['type'] != 'resource'),
+        resources=''.join(ews_attendee(a) for a in event['attendees'] if a['type'] == 'resource'),
+        online=str(event['isOnlineMeeting']).lower(),
+    )
+
+
+def timed(func, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def benchmark_parse(agenda, days, repeat):
+    start = datetime.date.today()
+    events = [e for n in range(days) for e in graph_stub.day_events('room@example.org', start + datetime.timedelta(n))]
+    fields = set(GRAPH_EVENT_FIELDS)
+
+    graph_payload = json.dumps({'value': [{k: v for k, v in e.items() if k in fields} for e in events]}).encode()
+    ews_payload = EWS_RESPONSE.format(count=len(events), items='\n'.join(ews_item(e) for e in events)).encode()
+
+    graph, ews = GraphBackend(agenda), EWSBackend(agenda)
+
+    def parse_graph():
+        return [graph.event_to_meeting(e) for e in json.loads(graph_payload)['value']]
+
+    def parse_ews():
+        root = to_xml(ews_payload).getroot()
+        items = [exchangelib.CalendarItem.from_xml(elem=e, account=None)
+                 for e in root.iter(exchangelib.CalendarItem.response_tag())]
+        return [ews.item_to_meeting(item) for item in items]
+
+    # both paths should end up with the same meetings
+    key = ('start', 'end', 'subject', 'location', 'all_day', 'online', 'my_response')
+    assert [[m[k] for k in key] for m in parse_ews()] == [[m[k] for k in key] for m in parse_graph()]
+
+    t_ews, t_graph = timed(parse_ews, repeat), timed(parse_graph, repeat)
+    print('Parsing {} events ({} days):'.format(len(events), days))
+    print('  EWS XML     {:8d} bytes  {:8.2f} ms  {:6.1f} us/event'.format(
+        len(ews_payload), t_ews * 1000, t_ews / len(events) * 1e6))
+    print('  Graph JSON  {:8d} bytes  {:8.2f} ms  {:6.1f} us/event'.format(
+        len(graph_payload), t_graph * 1000, t_graph / len(events) * 1e6))
+
+
+def benchmark_stub(mailboxes, days, repeat):
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, graph_stub.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/v1.0'.format(server.server_port)
+
+    agenda = OfflineAgenda(client_id='stub', client_secret='stub', email='bench@example.org', cache_file=None,
+                           scheduler=EWSScheduler(rate=10000, burst=10000), backend='graph', graph_url=url)
+    emails = ['room{}@example.org'.format(n) for n in range(mailboxes)]
+    date_start = datetime.date.today()
+    date_stop = date_start + datetime.timedelta(days=days - 1)
+
+    print('Fetching {} mailboxes, {} days, from the Graph stub:'.format(mailboxes, days))
+    for batch_size in (1, 20):
+        agenda.backend.batch_size = batch_size
+        before = agenda.backend.stats()
+
+        def fetch():
+            for email, meetings, error in agenda.iter_agendas(emails, date_start, date_stop, workers=4):
+                if error is not None:
+                    raise error
+
+        t = timed(fetch, repeat)
+        after = agenda.backend.stats()
+        print('  batch size {:2d}  {:8.2f} ms  {:4d} HTTP requests per run'.format(
+            batch_size, t * 1000, (after['batches'] - before['batches']) // repeat))
+    server.shutdown()
+    return agenda
+
+
+def benchmark_live(config_file, mailboxes, days, repeat):
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    settings = dict(config['config'])
+    settings.pop('backend', None)
+
+    date_start = datetime.date.today()
+    date_stop = date_start + datetime.timedelta(days=days - 1)
+    print('Fetching {} mailboxes, {} days, from the tenant:'.format(len(mailboxes), days))
+    for backend in ('ews', 'graph'):
+        agenda = SurfAgenda(backend=backend, **settings)
+        agenda.authenticate()
+
+        def fetch():
+            return [agenda.get_agenda_for_days(date_start, date_stop, email=email) for email in mailboxes]
+
+        fetch()  # warm up tokens and connections
+        t = timed(fetch, repeat)
+        print('  {:5s}  {:8.2f} ms  {:6d} meetings'.format(backend, t * 1000, sum(len(a) for a in fetch())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the EWS and Graph calendar backends')
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--mailboxes', type=int, default=60, help='number of mailboxes to fetch from the stub')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--config', help='also fetch real agendas with both backends, using this config file')
+    parser.add_argument('--mailbox', action='append', default=[], help='mailbox to fetch with --config')
+    args = parser.parse_args()
+
+    agenda = benchmark_stub(args.mailboxes, args.days, args.repeat)
+    benchmark_parse(agenda, args.days * 20, args.repeat)
+    if args.config:
+        benchmark_live(args.config, args.mailbox, args.days, args.repeat)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Minimal local stand-in for the Microsoft Graph calendar API, for testing and benchmarking the Graph backend
+# without a tenant. It implements just what GraphBackend uses: calendarView with $select/$top/$skip paging, and
+# JSON $batch. Every mailbox gets a deterministic, made-up agenda; mailboxes starting with "unknown" don't exist.
+#
+#   python graph_stub.py --port 5001
+#   SurfAgenda(..., backend="graph", graph_url="http://localhost:5001/v1.0")
+
+import argparse
+import datetime
+import random
+import urllib.parse
+import zlib
+
+import flask
+
+app = flask.Flask(__name__)
+app.config['THROTTLE_RATE'] = 0.0
+
+PEOPLE = ['Jan Jansen', 'Piet Pietersen', 'Klaas Klaassen', 'Marie Maas', 'Anna de Vries', 'Sophie Bakker']
+RESPONSES = ['accepted', 'tentativelyAccepted', 'declined', 'notResponded', 'none']
+
+
+def graph_time(dt):
+    return {'dateTime': dt.strftime('%Y-%m-%dT%H:%M:%S.0000000'), 'timeZone': 'UTC'}
+
+
+def address(name, domain='example.org'):
+    return {'name': name, 'address': '{}@{}'.format(name.lower().replace(' ', '.'), domain)}
+
+
+# all events of a mailbox on a single day, the same every time
+def day_events(email, day):
+    rnd = random.Random(zlib.crc32('{}/{}'.format(email, day.isoformat()).encode()))
+    events = list()
+    if rnd.random() < 0.1:
+        start = datetime.datetime.combine(day, datetime.time.min)
+        events.append({'start': start, 'end': start + datetime.timedelta(days=1), 'isAllDay': True})
+    hour = 7.0
+    while True:
+        hour += rnd.choice([0, 0.5, 1, 1.5, 2])
+        duration = rnd.choice([0.5, 1, 1, 1.5, 2])
+        if hour + duration > 17:
+            break
+        start = datetime.datetime.combine(day, datetime.time.min) + datetime.timedelta(hours=hour)
+        events.append({'start': start, 'end': start + datetime.timedelta(hours=duration), 'isAllDay': False})
+        hour += duration
+
+    for n, event in enumerate(events):
+        organizer = address(rnd.choice(PEOPLE))
+        attendees = [
+            {'type': rnd.choice(['required', 'optional']), 'emailAddress': address(name),
+             'status': {'response': rnd.choice(RESPONSES), 'time': '0001-01-01T00:00:00Z'}}
+            for name in rnd.sample(PEOPLE, rnd.randint(1, 4))
+        ]
+        attendees.append({'type': 'resource', 'emailAddress': {'name': 'Room', 'address': email},
+                          'status': {'response': 'accepted', 'time': '0001-01-01T00:00:00Z'}})
+        event_id = 'AAMk{:08x}{:04d}'.format(zlib.crc32(email.encode()), day.toordinal() * 100 + n)
+        event.update({
+            'id': event_id,
+            'changeKey': 'ck{:08x}'.format(zlib.crc32(event_id.encode())),
+            'subject': 'Overleg {}'.format(n + 1),
+            'bodyPreview': 'Agenda: ...',
+            'body': {'contentType': 'text', 'content': 'Agenda:\n1. opening\n2. rondvraag\n' * 10},
+            'sensitivity': 'private' if rnd.random() < 0.05 else 'normal',
+            'organizer': {'emailAddress': organizer},
+            'attendees': attendees,
+            'location': {'displayName': 'Vergaderzaal {}.{}'.format(rnd.randint(1, 5), rnd.randint(1, 20)),
+                         'locationType': 'default'},
+            'isOnlineMeeting': rnd.random() < 0.5,
+            'responseStatus': {'response': rnd.choice(RESPONSES), 'time': '0001-01-01T00:00:00Z'},
+            # fields a real event has as well, that the backend doesn't ask for
+            'categories': [], 'importance': 'normal', 'showAs': 'busy', 'webLink': 'https://example.org/' + event_id,
+            'onlineMeeting': None, 'recurrence': None, 'seriesMasterId': None, 'type': 'singleInstance',
+        })
+        event['start'], event['end'] = graph_time(event['start']), graph_time(event['end'])
+    return events
+
+
+def parse_time(value):
+    t = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return t
+
+
+# returns (status, headers, body) for a calendarView request
+def calendar_view(email, args, base_url):
+    if email.lower().startswith('unknown'):
+        return 404, {}, {'error': {'code': 'ErrorInvalidUser', 'message': 'The requested user is invalid.'}}
+    if random.random() < app.config['THROTTLE_RATE']:
+        return 429, {'Retry-After': '1'}, {'error': {'code': 'TooManyRequests', 'message': 'Too many requests'}}
+    try:
+        start, end = parse_time(args['startDateTime']), parse_time(args['endDateTime'])
+    except (KeyError, ValueError):
+        return 400, {}, {'error': {'code': 'ErrorInvalidParameter', 'message': 'startDateTime and endDateTime'}}
+    top, skip = int(args.get('$top', 10)), int(args.get('$skip', 0))
+
+    events = list()
+    day = start.date()
+    while day <= end.date():
+        events.extend(e for e in day_events(email, day)
+                      if e['start']['dateTime'][:19] < end.isoformat()
+                      and e['end']['dateTime'][:19] > start.isoformat())
+        day += datetime.timedelta(days=1)
+
+    if '$select' in args:
+        fields = set(args['$select'].split(',')) | {'id'}
+        events = [{k: v for k, v in e.items() if k in fields} for e in events]
+
+    body = {'value': events[skip:skip + top]}
+    if skip + top < len(events):
+        query = dict(args, **{'$skip': str(skip + top)})
+        body['@odata.nextLink'] = '{}/users/{}/calendarView?{}'.format(
+            base_url, urllib.parse.quote(email), urllib.parse.urlencode(query, safe='$/,:'))
+    return 200, {}, body
+
+
+def base_url():
+    return flask.request.host_url.rstrip('/') + '/v1.0'
+
+
+@app.route('/v1.0/users/<email>/calendarView')
+def users_calendar_view(email):
+    status, headers, body = calendar_view(email, flask.request.args.to_dict(), base_url())
+    return flask.jsonify(body), status, headers
+
+
+@app.route('/v1.0/$batch', methods=['POST'])
+def batch():
+    requests = flask.request.get_json()['requests']
+    if len(requests) > 20:
+        return flask.jsonify({'error': {'code': 'BadRequest', 'message': 'Too many requests in batch'}}), 400
+
+    responses = list()
+    for request in requests:
+        url = urllib.parse.urlsplit(request['url'])
+        parts = url.path.strip('/').split('/')
+        if request['method'] != 'GET' or len(parts) != 3 or parts[0] != 'users' or parts[2] != 'calendarView':
+            status, headers, body = 400, {}, {'error': {'code': 'BadRequest', 'message': 'Not supported by stub'}}
+        else:
+            args = dict(urllib.parse.parse_qsl(url.query))
+            status, headers, body = calendar_view(urllib.parse.unquote(parts[1]), args, base_url())
+        responses.append({'id': request['id'], 'status': status, 'headers': headers, 'body': body})
+    return flask.jsonify({'responses': responses})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stub of the Microsoft Graph calendar API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--throttle', type=float, default=0.0, help='fraction of requests to answer with 429')
+    args = parser.parse_args()
+    app.config['THROTTLE_RATE'] = args.throttle
+    app.run(host=args.host, port=args.port, threaded=True)
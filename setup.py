@@ -10,6 +10,8 @@ setup(
     license="APL2",
     packages=["surfagenda"],
     install_requires=["exchangelib", "ordereddict", "Flask", "python-dateutil", "pytz"],
+    extras_require={"brotli": ["brotli"], "analytics": ["numpy"]},
+    entry_points={"console_scripts": ["surfagenda=surfagenda.cli:main"]},
     python_requires=">=3.11",
     zip_safe=False,
 )
@@ -1 +1,7 @@
-from .surfagenda import SurfAgenda, JSONAgendaEncoder
+from .surfagenda import SurfAgenda, JSONAgendaEncoder, data_digest
+from .scheduler import EWSScheduler, Priority
+from .ics import IcsFeed, IcsFeedCache
+from .breaker import CircuitBreaker, CircuitOpenError
+from .rooms import RoomDirectory
+from .people import PeopleResolver
+from .backends import CalendarBackend, EWSBackend, GraphBackend
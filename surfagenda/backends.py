@@ -0,0 +1,571 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import threading
+import time
+import urllib.parse
+
+import exchangelib
+import exchangelib.errors
+import requests
+from exchangelib import Account
+
+from . import recurrence
+from .meeting import Attendee, GRAPH_RESPONSE_TYPES, ResponseType
+from .scheduler import Priority
+
+# Calendar backends: where SurfAgenda gets its calendar data from. Authentication, scheduling and circuit breaking
+# stay in SurfAgenda; a backend only knows how to fetch the meetings of mailboxes, and returns them as meeting
+# dicts with the same structure, whatever the source.
+
+DEFAULT_GRAPH_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_BATCH_SIZE = 20  # maximum number of requests in a Graph JSON batch
+GRAPH_PAGE_SIZE = 100
+# delegated Graph scopes needed to read the calendars of others
+GRAPH_CALENDAR_SCOPE = ["Calendars.Read", "Calendars.Read.Shared"]
+# only the fields we actually use
+GRAPH_EVENT_FIELDS = (
+    "id",
+    "changeKey",
+    "subject",
+    "body",
+    "start",
+    "end",
+    "isAllDay",
+    "sensitivity",
+    "organizer",
+    "attendees",
+    "location",
+    "isOnlineMeeting",
+    "responseStatus",
+)
+# times in UTC and bodies as plain text, like we get them from EWS
+GRAPH_PREFER = 'outlook.timezone="UTC", outlook.body-content-type="text"'
+GRAPH_MAX_BACK_OFF = 30  # seconds
+# EWS calendar views are fetched in windows of this size
+DEFAULT_EWS_WINDOW = datetime.timedelta(days=7)
+
+
+class CalendarBackend:
+    # number of mailboxes that get_agendas() handles in one go
+    batch_size = 1
+
+    def __init__(self, agenda):
+        self.logger = logging.getLogger(__name__)
+        self.agenda = agenda
+
+    # Meetings of a mailbox that overlap with [dt_start, dt_stop], in order of start time. Meetings are yielded as
+    # they are fetched, so callers that don't need all of them can stop early.
+    def iter_agenda(
+        self,
+        email,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+        expand_recurrence: bool = False,
+    ):
+        raise NotImplementedError
+
+    def get_agenda(
+        self,
+        email,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+        expand_recurrence: bool = False,
+    ) -> list[dict]:
+        return list(self.iter_agenda(email, dt_start, dt_stop, priority=priority, expand_recurrence=expand_recurrence))
+
+    # agendas of several mailboxes, as a dict of email to either the agenda, or the exception that prevented
+    # fetching it
+    def get_agendas(
+        self,
+        emails: list,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> dict:
+        agendas = dict()
+        for email in emails:
+            try:
+                agendas[email] = self.get_agenda(email, dt_start, dt_stop, priority=priority)
+            except Exception as e:
+                agendas[email] = e
+        return agendas
+
+    def stats(self) -> dict:
+        return dict()
+
+
+# convert an EWS date or datetime to a datetime in timezone tz
+def ewstime2datetime(t: exchangelib.EWSDate | exchangelib.EWSDateTime, tz: datetime.tzinfo) -> datetime.datetime:
+    # note that EWSDate is a subclass of datetime.date, and EWSDateTime is a subclass of datetime,
+    # which itself is a subclass of datetime.date; so check for datetime first
+    if isinstance(t, datetime.datetime):
+        # not t.astimezone(tz): EWSDateTime.astimezone() replaces the tzinfo afterwards, which gives pytz zones
+        # their LMT offset
+        return datetime.datetime.astimezone(t, tz)
+    elif isinstance(t, datetime.date):
+        return tz.localize(datetime.datetime.combine(t, datetime.time.min))
+    raise ValueError("Unknown type")
+
+
+# the meeting structure, whatever the backend
+def _meeting(
+    start,
+    end,
+    all_day,
+    organizer,
+    online,
+    subject,
+    description,
+    location,
+    attendees,
+    resources,
+    my_response,
+    item_id,
+    changekey,
+) -> dict:
+    return {
+        "start": start,
+        "end": end,
+        "time_start": start.strftime("%H:%M"),
+        "time_end": end.strftime("%H:%M"),
+        "date_start": start.strftime("%Y-%m-%d"),
+        "date_end": end.strftime("%Y-%m-%d"),
+        "duration": end - start,
+        "all_day": all_day,
+        "organizer": organizer,
+        "online": online,
+        "subject": subject,
+        "description": description,
+        "location": location,
+        "attendees": attendees,
+        "resources": resources,
+        "my_response": my_response,
+        "id": item_id,
+        "changekey": changekey,
+    }
+
+
+class EWSBackend(CalendarBackend):
+    def __init__(self, agenda, window=DEFAULT_EWS_WINDOW):
+        super().__init__(agenda)
+        self.window = window
+        # recurring master items per mailbox, used to expand occurrences locally instead of on the server
+        self._masters = dict()
+        self._lock = threading.Lock()
+
+    # The range is fetched in windows of `window`, one EWS request (or a few, when expanding recurring meetings
+    # locally) each. Meetings that span several windows are returned by the views of all of them, but are only
+    # yielded from the window in which they start; so only a single window is held in memory at a time.
+    def iter_agenda(
+        self,
+        email,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+        expand_recurrence: bool = False,
+    ):
+        account = self.agenda._get_account(email)
+
+        window_start = dt_start
+        while window_start < dt_stop:
+            window_stop = min(window_start + self.window, dt_stop)
+            for meeting in self._get_window(account, email, window_start, window_stop, priority, expand_recurrence):
+                if window_start == dt_start or meeting["start"] >= window_start:
+                    yield meeting
+            window_start = window_stop
+
+    # all meetings in a single window, sorted by start time
+    def _get_window(
+        self,
+        account: Account,
+        email,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+        expand_recurrence: bool = False,
+    ) -> list[dict]:
+        if expand_recurrence:
+            try:
+                return self._get_agenda_expanded(account, email, dt_start, dt_stop, priority)
+            except NotImplementedError as e:
+                self.logger.info("Can't expand recurring items locally, letting the server do it: %s", e)
+
+        # the view is evaluated lazily, so make sure the actual fetch happens inside the scheduler
+        items = self.agenda._ews(
+            lambda: list(
+                account.calendar.view(
+                    exchangelib.EWSDateTime.from_datetime(dt_start),
+                    exchangelib.EWSDateTime.from_datetime(dt_stop),
+                )
+            ),
+            priority=priority,
+            mailbox=account.primary_smtp_address,
+        )
+        # all-day items start with a date rather than a datetime, so only sort once they are converted
+        meetings = [self.item_to_meeting(item) for item in items]
+        meetings.sort(key=lambda a: a["start"])
+        return meetings
+
+    # convert an EWS calendar item to our own meeting structure.
+    # start and end can be passed explicitly for occurrences of a recurring master that were expanded locally
+    def item_to_meeting(
+        self,
+        item: exchangelib.CalendarItem,
+        start: datetime.datetime | None = None,
+        end: datetime.datetime | None = None,
+    ) -> dict:
+        is_private = item.sensitivity.lower() == "private"
+
+        # locally expanded occurrences don't have an id of their own
+        item_id = item.id
+        if start is not None:
+            item_id = "{}/{}".format(item.id, start.astimezone(datetime.timezone.utc).isoformat())
+
+        attendees = list()
+        if not is_private:
+            # note that optional_attendees and required_attendees might be None
+            attendees = set(
+                Attendee.from_ews(p) for p in (item.optional_attendees or []) + (item.required_attendees or [])
+            )
+
+        resources = list()
+        if not is_private:
+            # note that optional_attendees and required_attendees might be None
+            resources = set(Attendee.from_ews(p) for p in (item.resources or []))
+
+        organizer = Attendee()
+        if item.organizer and not is_private:
+            organizer = Attendee(item.organizer.name, item.organizer.email_address, ResponseType.ORGANIZER)
+
+            # this corrects the responsetype;
+            # works because Attendee equality only considers email addresses
+            if organizer in attendees:
+                attendees.remove(organizer)
+            attendees.add(organizer)
+
+        start = ewstime2datetime(start if start is not None else item.start, self.agenda.tz)
+        end = ewstime2datetime(end if end is not None else item.end, self.agenda.tz)
+
+        meeting = _meeting(
+            start,
+            end,
+            all_day=item.is_all_day,
+            organizer=organizer,
+            online=item.is_online_meeting,
+            subject=item.subject if not is_private else "Private appointment",
+            description=item.text_body if not is_private else "",
+            location=item.location if not is_private else "Undisclosed",
+            attendees=attendees,
+            resources=resources,
+            my_response=ResponseType(item.my_response_type),
+            item_id=item_id,
+            changekey=item.changekey,
+        )
+        self.logger.debug("  - {start}-{end}: {subject}".format(**meeting))
+        return meeting
+
+    # Fetch the agenda by expanding recurring items locally, from cached master items.
+    # Only the non-recurring items in the requested window are fetched from the server every time.
+    def _get_agenda_expanded(
+        self,
+        account: Account,
+        email,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+    ):
+        recurring = self._get_recurring_masters(account, email, priority)
+
+        singles = self.agenda._ews(
+            lambda: list(
+                account.calendar.filter(
+                    start__lt=exchangelib.EWSDateTime.from_datetime(dt_stop),
+                    end__gt=exchangelib.EWSDateTime.from_datetime(dt_start),
+                    type="Single",
+                )
+            ),
+            priority=priority,
+            mailbox=account.primary_smtp_address,
+        )
+        meetings = [self.item_to_meeting(item) for item in singles]
+
+        for master in recurring["masters"].values():
+            for item, start, end in recurrence.occurrences(
+                master, recurring["exceptions"], dt_start, dt_stop, self.agenda.tz
+            ):
+                meetings.append(self.item_to_meeting(item, start, end))
+
+        meetings.sort(key=lambda a: a["start"])
+        return meetings
+
+    # Recurring master items of a mailbox, and the items of their modified occurrences, by item id.
+    # After recurrence_ttl, we only ask the server for ids and changekeys, and refetch just the items that changed.
+    def _get_recurring_masters(self, account: Account, email, priority: Priority = Priority.INTERACTIVE) -> dict:
+        key = email
+        with self._lock:
+            entry = self._masters.get(key)
+        if entry is not None and time.time() - entry["updated"] <= self.agenda.recurrence_ttl:
+            return entry
+
+        known_masters = entry["masters"] if entry is not None else dict()
+        known_exceptions = entry["exceptions"] if entry is not None else dict()
+
+        current = self.agenda._ews(
+            lambda: list(account.calendar.filter(type="RecurringMaster").values_list("id", "changekey")),
+            priority=priority,
+            mailbox=account.primary_smtp_address,
+        )
+        masters = {i: known_masters[i] for i, ck in current if i in known_masters and known_masters[i].changekey == ck}
+        masters.update(self._fetch_items(account, [(i, ck) for i, ck in current if i not in masters], priority))
+
+        current = [(o.id, o.changekey) for m in masters.values() for o in (m.modified_occurrences or [])]
+        exceptions = {
+            i: known_exceptions[i] for i, ck in current if i in known_exceptions and known_exceptions[i].changekey == ck
+        }
+        exceptions.update(self._fetch_items(account, [(i, ck) for i, ck in current if i not in exceptions], priority))
+
+        self.logger.debug(
+            "recurring items for %s: %d masters, %d exceptions", key, len(masters), len(exceptions)
+        )
+        entry = {"updated": time.time(), "masters": masters, "exceptions": exceptions}
+        with self._lock:
+            self._masters[key] = entry
+        return entry
+
+    def _fetch_items(self, account: Account, ids: list, priority: Priority = Priority.INTERACTIVE) -> dict:
+        if not ids:
+            return dict()
+        fetched = dict()
+        items = self.agenda._ews(
+            lambda: list(account.fetch(ids=ids)), priority=priority, mailbox=account.primary_smtp_address
+        )
+        for item in items:
+            if isinstance(item, Exception):
+                # e.g., the item was removed in the meantime
+                self.logger.warning("Could not fetch calendar item: %s", item)
+                continue
+            fetched[item.id] = item
+        return fetched
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"recurring_masters": sum(len(entry["masters"]) for entry in self._masters.values())}
+
+
+class GraphError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__("Graph request failed with status {}: {}".format(status, message))
+        self.status = status
+
+
+# Graph itself is in trouble (5xx), as opposed to a problem with the request; counts as an upstream failure
+class GraphServerError(GraphError):
+    pass
+
+
+# Microsoft Graph: calendarView returns occurrences expanded by the server, like the EWS view does. Requests for
+# up to 20 mailboxes are combined in a single JSON $batch request, and only the fields we need are requested.
+class GraphBackend(CalendarBackend):
+    batch_size = GRAPH_BATCH_SIZE
+
+    def __init__(self, agenda, base_url=DEFAULT_GRAPH_URL, batch_size=GRAPH_BATCH_SIZE, page_size=GRAPH_PAGE_SIZE):
+        super().__init__(agenda)
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = max(1, min(int(batch_size), GRAPH_BATCH_SIZE))
+        self.page_size = int(page_size)
+        self._session = requests.Session()
+        self._counters = {"batches": 0, "requests": 0, "throttled": 0}
+        self._lock = threading.Lock()
+
+    def _calendar_view_url(self, email, dt_start: datetime.datetime, dt_stop: datetime.datetime) -> str:
+        query = urllib.parse.urlencode(
+            {
+                "startDateTime": dt_start.astimezone(datetime.timezone.utc).isoformat(),
+                "endDateTime": dt_stop.astimezone(datetime.timezone.utc).isoformat(),
+                "$select": ",".join(GRAPH_EVENT_FIELDS),
+                "$orderby": "start/dateTime",
+                "$top": self.page_size,
+            },
+            safe="$/,:",
+        )
+        return "/users/{}/calendarView?{}".format(urllib.parse.quote(email), query)
+
+    def _relative(self, url: str) -> str:
+        # nextLinks are absolute, requests in a batch need to be relative to the service root
+        return url[len(self.base_url) :] if url.startswith(self.base_url) else url
+
+    def _post_batch(self, requests_: list[dict]) -> list[dict]:
+        response = self._session.post(
+            self.base_url + "/$batch",
+            json={"requests": requests_},
+            headers={"Authorization": "Bearer {}".format(self.agenda.get_graph_token()["access_token"])},
+            timeout=self.agenda.ews_timeout,
+        )
+        if response.status_code in (429, 503):
+            back_off = float(response.headers.get("Retry-After", 0)) or None
+            raise exchangelib.errors.ErrorServerBusy("Graph is throttling us", back_off=back_off)
+        if response.status_code >= 500:
+            raise GraphServerError(response.status_code, response.reason)
+        response.raise_for_status()
+        with self._lock:
+            self._counters["batches"] += 1
+            self._counters["requests"] += len(requests_)
+        responses = response.json()["responses"]
+
+        # when every request in the batch failed on the server side, Graph is in trouble rather than some mailboxes;
+        # raise here, so the scheduler backs off and the circuit breaker sees the failure
+        statuses = [r["status"] for r in responses]
+        if statuses and all(status in (429, 503, 504) for status in statuses):
+            back_off = max(float((r.get("headers") or dict()).get("Retry-After", 0)) for r in responses) or None
+            raise exchangelib.errors.ErrorServerBusy("Graph is throttling us", back_off=back_off)
+        if statuses and all(status >= 500 or status == 429 for status in statuses):
+            raise GraphServerError(max(statuses), "all requests in the batch failed")
+        return responses
+
+    # One round of requests: the next page of (at most batch_size of) the pending mailboxes, in a single batch.
+    # Returns the events per mailbox that got a page; mailboxes that are done are removed from `pending`, and failed
+    # ones are moved to `failed`, with the exception.
+    def _fetch_round(self, pending: dict, retries: dict, failed: dict, priority: Priority) -> dict:
+        batch = list(pending.items())[: self.batch_size]
+        requests_ = [
+            {"id": str(n), "method": "GET", "url": url, "headers": {"Prefer": GRAPH_PREFER}}
+            for n, (_, url) in enumerate(batch)
+        ]
+        responses = self.agenda._ews(self._post_batch, requests_, priority=priority)
+
+        pages = dict()
+        back_off = 0.0
+        for response in responses:
+            email = batch[int(response["id"])][0]
+            status = response["status"]
+            body = response.get("body") or dict()
+            if status == 200:
+                retries[email] = 0
+                pages[email] = body.get("value", ())
+                next_link = body.get("@odata.nextLink")
+                if next_link:
+                    pending[email] = self._relative(next_link)
+                else:
+                    del pending[email]
+            elif status in (429, 503, 504) and retries.get(email, 0) < self.agenda.scheduler.max_retries:
+                # throttled: try this page again in a later round
+                retries[email] = retries.get(email, 0) + 1
+                headers = response.get("headers") or dict()
+                back_off = max(back_off, float(headers.get("Retry-After", 1)))
+                with self._lock:
+                    self._counters["throttled"] += 1
+            else:
+                del pending[email]
+                failed[email] = self._error(email, status, body)
+        if back_off:
+            time.sleep(min(back_off, GRAPH_MAX_BACK_OFF))
+        return pages
+
+    # the server always expands recurring meetings for calendarView, and returns them ordered by start time; every
+    # page is converted and yielded before the next one is fetched
+    def iter_agenda(
+        self,
+        email,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+        expand_recurrence: bool = False,
+    ):
+        pending = {email: self._calendar_view_url(email, dt_start, dt_stop)}
+        retries = dict()
+        failed = dict()
+        while pending:
+            for event in self._fetch_round(pending, retries, failed, priority).get(email, ()):
+                yield self.event_to_meeting(event)
+        if email in failed:
+            raise failed[email]
+
+    def get_agendas(
+        self,
+        emails: list,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> dict:
+        # next url to fetch per mailbox; pages of all mailboxes are fetched together, round by round
+        pending = {email: self._calendar_view_url(email, dt_start, dt_stop) for email in emails}
+        agendas = {email: list() for email in emails}
+        retries = dict()
+        failed = dict()
+        while pending:
+            for email, events in self._fetch_round(pending, retries, failed, priority).items():
+                agendas[email].extend(self.event_to_meeting(event) for event in events)
+        agendas.update(failed)
+        return agendas
+
+    @staticmethod
+    def _error(email, status: int, body: dict) -> Exception:
+        message = (body.get("error") or dict()).get("message", "")
+        if status == 404:
+            return exchangelib.errors.ErrorNonExistentMailbox("Mailbox does not exist: {}".format(email))
+        if status in (429, 503, 504):
+            return exchangelib.errors.ErrorServerBusy("Graph is throttling requests for {}".format(email))
+        if status >= 500:
+            return GraphServerError(status, message)
+        return GraphError(status, message)
+
+    def _graph_time(self, value: dict, all_day: bool, end: bool = False) -> datetime.datetime:
+        # e.g. {"dateTime": "2024-10-01T09:00:00.0000000", "timeZone": "UTC"}
+        t = datetime.datetime.fromisoformat(value["dateTime"])
+        if all_day:
+            # all-day events are dates, regardless of time zones; like exchangelib does for EWS, the end date is
+            # made inclusive
+            date = t.date() - datetime.timedelta(days=1) if end else t.date()
+            return self.agenda.tz.localize(datetime.datetime.combine(date, datetime.time.min))
+        return t.replace(tzinfo=datetime.timezone.utc).astimezone(self.agenda.tz)
+
+    # convert a Graph event to our own meeting structure
+    def event_to_meeting(self, event: dict) -> dict:
+        is_private = event.get("sensitivity") == "private"
+
+        attendees = list()
+        resources = list()
+        if not is_private:
+            attendees, resources = set(), set()
+            for attendee in event.get("attendees") or ():
+                if attendee.get("type") == "resource":
+                    resources.add(Attendee.from_graph(attendee))
+                else:
+                    attendees.add(Attendee.from_graph(attendee))
+
+        organizer = Attendee()
+        address = (event.get("organizer") or dict()).get("emailAddress")
+        if address and not is_private:
+            organizer = Attendee(address.get("name"), address.get("address"), ResponseType.ORGANIZER)
+            # see item_to_meeting of the EWS backend
+            if organizer in attendees:
+                attendees.remove(organizer)
+            attendees.add(organizer)
+
+        all_day = bool(event.get("isAllDay"))
+        body = event.get("body") or dict()
+        location = (event.get("location") or dict()).get("displayName")
+        response = (event.get("responseStatus") or dict()).get("response")
+        return _meeting(
+            self._graph_time(event["start"], all_day),
+            self._graph_time(event["end"], all_day, end=True),
+            all_day=all_day,
+            organizer=organizer,
+            online=bool(event.get("isOnlineMeeting")),
+            subject=event.get("subject") if not is_private else "Private appointment",
+            description=body.get("content") if not is_private else "",
+            location=location if not is_private else "Undisclosed",
+            attendees=attendees,
+            resources=resources,
+            my_response=GRAPH_RESPONSE_TYPES.get(response, ResponseType.UNKNOWN),
+            item_id=event["id"],
+            changekey=event.get("changeKey"),
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+import exchangelib.errors
+import requests.exceptions
+
+from .backends import GraphServerError
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__("Circuit '{}' is open, retry after {:.0f}s".format(name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+
+# exchangelib raises plain TransportErrors for HTTP errors and failed connections, while its subclasses are mostly
+# errors about the request itself; SurfAgenda raises this instead of a plain one, so they can be told apart by class
+class UpstreamTransportError(exchangelib.errors.TransportError):
+    pass
+
+
+# errors that indicate that Exchange (or Graph) itself is in trouble (as opposed to, e.g., a request for an unknown
+# mailbox)
+UPSTREAM_ERRORS = (
+    CircuitOpenError,
+    exchangelib.errors.RateLimitError,
+    exchangelib.errors.ErrorServerBusy,
+    exchangelib.errors.ErrorTimeoutExpired,
+    exchangelib.errors.ErrorInternalServerError,
+    exchangelib.errors.ErrorInternalServerTransientError,
+    exchangelib.errors.ErrorConnectionFailed,
+    exchangelib.errors.ErrorConnectionFailedTransientError,
+    exchangelib.errors.ErrorMailboxStoreUnavailable,
+    GraphServerError,
+    UpstreamTransportError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_upstream_failure(e: BaseException) -> bool:
+    # plain TransportErrors are raised for HTTP errors; its subclasses are mostly errors about the request itself
+    return isinstance(e, UPSTREAM_ERRORS) or type(e) is exchangelib.errors.TransportError
+
+
+# Classic circuit breaker: after `failure_threshold` consecutive upstream failures the circuit opens, and calls
+# fail immediately with CircuitOpenError. After `reset_timeout` seconds a single trial call is let through
+# (half-open); if it succeeds the circuit closes again, otherwise it stays open for another period.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened = 0.0
+        self._trial_running = False
+        self._counters = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def _before(self):
+        with self._lock:
+            self._counters["calls"] += 1
+            if self._state == self.CLOSED:
+                return
+
+            retry_after = self._opened + self.reset_timeout - time.monotonic()
+            if self._state == self.OPEN and retry_after <= 0:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+
+            self._counters["rejected"] += 1
+            raise CircuitOpenError(self.name, max(retry_after, 0))
+
+    def _on_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                self.logger.info("Circuit '%s' closed", self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def _on_failure(self):
+        with self._lock:
+            self._counters["failures"] += 1
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.logger.warning("Circuit '%s' opened after %d failures", self.name, self._failures)
+                    self._counters["opened"] += 1
+                self._state = self.OPEN
+                self._opened = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        self._before()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self._on_failure()
+            else:
+                # the server did respond, so as far as we're concerned it's up
+                self._on_success()
+            raise
+        except BaseException:
+            with self._lock:
+                self._trial_running = False
+            raise
+        self._on_success()
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self._state, "consecutive_failures": self._failures, **self._counters}
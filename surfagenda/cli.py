@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import argparse
+import configparser
+import contextlib
+import json
+import logging
+import sys
+
+from .surfagenda import SurfAgenda, JSONAgendaEncoder
+
+
+# Non-interactive export of agendas as newline-delimited JSON: one line per mailbox, written as soon as that
+# mailbox is done.
+#
+#   surfagenda --start today --stop +6 alice@surf.nl bob@surf.nl
+#   surfagenda --all-rooms --start 1-10-2024 --stop 31-10-2024 --workers 8
+#   cat mailboxes.txt | surfagenda --start today -
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="surfagenda", description="Export Exchange agendas as NDJSON")
+    parser.add_argument(
+        "mailboxes",
+        nargs="*",
+        help="email addresses of the mailboxes to export; use - to read them from stdin, one per line",
+    )
+    parser.add_argument("--all-rooms", action="store_true", help="export the agendas of all meeting rooms")
+    parser.add_argument("--start", default="today", help="first day to export (default: today)")
+    parser.add_argument("--stop", default=None, help="last day to export (default: same as --start)")
+    parser.add_argument("--workers", type=int, default=4, help="number of mailboxes to fetch concurrently")
+    parser.add_argument("--config", default=None, help="config file with a [config] section for SurfAgenda")
+    parser.add_argument("--debug", action="store_true", help="log debug output to stderr")
+    args = parser.parse_args(argv)
+
+    if not args.mailboxes and not args.all_rooms:
+        parser.error("specify one or more mailboxes, or --all-rooms")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+def read_config(filename):
+    config = configparser.ConfigParser()
+    with open(filename) as f:
+        config.read_file(f)
+    return config._sections["config"]
+
+
+def iter_mailboxes(args, exchange: SurfAgenda):
+    # yields (email, extra fields for the output line)
+    for mailbox in args.mailboxes:
+        if mailbox == "-":
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield line, dict()
+        else:
+            yield mailbox, dict()
+    if args.all_rooms:
+        for room in exchange.get_rooms().values():
+            yield room["email"], {"room": room["number"]}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if args.debug else logging.WARNING)
+
+    config = read_config(args.config) if args.config else dict()
+    exchange = SurfAgenda(**config)
+
+    # make sure we are logged in before we start; the login instructions must not end up in the output
+    with contextlib.redirect_stdout(sys.stderr):
+        exchange.authenticate()
+
+    date_start = exchange._parse_date(args.start)
+    date_stop = exchange._parse_date(args.stop) if args.stop else date_start
+
+    # remember the extra fields of mailboxes that are in flight, so they can be added to the output
+    extra = dict()
+
+    def mailboxes():
+        for email, fields in iter_mailboxes(args, exchange):
+            extra[email] = fields
+            yield email
+
+    failed = 0
+    for email, agenda, error in exchange.iter_agendas(mailboxes(), date_start, date_stop, workers=args.workers):
+        line = {"email": email, "start": date_start, "stop": date_stop, **extra.pop(email, dict())}
+        if error is None:
+            line["agenda"] = agenda
+        else:
+            line["error"] = "{}: {}".format(type(error).__name__, error)
+            failed += 1
+        sys.stdout.write(json.dumps(line, sort_keys=True, cls=JSONAgendaEncoder) + "\n")
+        sys.stdout.flush()
+
+    return 1 if failed else 0
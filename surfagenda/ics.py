@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import datetime
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from .breaker import is_upstream_failure
+from .surfagenda import ResponseType, meeting_fingerprint
+
+# iCalendar (RFC 5545) feeds of agendas.
+# Every event is serialised once and kept, together with a fingerprint of the meeting it was generated from. When
+# the agenda is refreshed, only new or changed meetings are serialised again, and the feed itself is streamed
+# from the cached event texts.
+
+PRODID = "-//SURF//SurfAgenda//EN"
+DEFAULT_DAYS_BEFORE = 7
+DEFAULT_DAYS_AFTER = 28
+DEFAULT_CACHE_SIZE = 500  # number of feeds
+
+# control characters aren't allowed in property values; line breaks would even start a new property
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x1f\x7f]")
+
+PARTSTAT = {
+    ResponseType.ORGANIZER: "ACCEPTED",
+    ResponseType.ACCEPT: "ACCEPTED",
+    ResponseType.DECLINE: "DECLINED",
+    ResponseType.TENTATIVE: "TENTATIVE",
+    ResponseType.NORESPONSE: "NEEDS-ACTION",
+    ResponseType.UNKNOWN: "NEEDS-ACTION",
+}
+
+
+def _escape(text) -> str:
+    text = (
+        str(text or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+        .replace("\r", "\\n")
+    )
+    return CONTROL_CHARACTERS.sub(" ", text)
+
+
+def _param(text) -> str:
+    # parameter values can't be escaped, only quoted
+    return '"{}"'.format(CONTROL_CHARACTERS.sub(" ", str(text or "").replace('"', "'")))
+
+
+def _fold(line: str) -> str:
+    # lines are limited to 75 octets; continuation lines start with a space
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts = list()
+    limit = 75
+    while encoded:
+        cut = min(limit, len(encoded))
+        # don't split multi-byte utf-8 sequences
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+        limit = 74
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _utc(dt: datetime.datetime) -> str:
+    return dt.astimezone(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _mailto(attendee) -> str:
+    return "mailto:{}".format(CONTROL_CHARACTERS.sub("", attendee.email))
+
+
+def meeting_uid(meeting: dict) -> str:
+    return "{}@surfagenda".format(hashlib.sha1(meeting["id"].encode("utf-8")).hexdigest())
+
+
+def vevent(meeting: dict, dtstamp: datetime.datetime) -> str:
+    lines = [
+        "BEGIN:VEVENT",
+        "UID:{}".format(meeting_uid(meeting)),
+        "DTSTAMP:{}".format(_utc(dtstamp)),
+    ]
+    if meeting["all_day"]:
+        lines.append("DTSTART;VALUE=DATE:{}".format(meeting["start"].strftime("%Y%m%d")))
+        # our end date is inclusive, DTEND is not
+        end = meeting["end"].date() + datetime.timedelta(days=1)
+        lines.append("DTEND;VALUE=DATE:{}".format(end.strftime("%Y%m%d")))
+    else:
+        lines.append("DTSTART:{}".format(_utc(meeting["start"])))
+        lines.append("DTEND:{}".format(_utc(meeting["end"])))
+    lines.append("SUMMARY:{}".format(_escape(meeting["subject"])))
+    if meeting["location"]:
+        lines.append("LOCATION:{}".format(_escape(meeting["location"])))
+    if meeting["description"]:
+        lines.append("DESCRIPTION:{}".format(_escape(meeting["description"])))
+
+    organizer = meeting["organizer"]
+    if organizer.email:
+        lines.append("ORGANIZER;CN={}:{}".format(_param(organizer.name), _mailto(organizer)))
+    for attendee in sorted(meeting["attendees"], key=lambda a: a.email or ""):
+        if attendee.email and attendee != organizer:
+            lines.append(
+                "ATTENDEE;CN={};PARTSTAT={}:{}".format(
+                    _param(attendee.name), PARTSTAT[attendee.response], _mailto(attendee)
+                )
+            )
+    for resource in sorted(meeting["resources"], key=lambda a: a.email or ""):
+        if resource.email:
+            lines.append(
+                "ATTENDEE;CN={};CUTYPE=RESOURCE;PARTSTAT={}:{}".format(
+                    _param(resource.name), PARTSTAT[resource.response], _mailto(resource)
+                )
+            )
+    lines.append("END:VEVENT")
+    return "".join(_fold(line) for line in lines)
+
+
+class IcsFeed:
+    def __init__(self, email: str):
+        self.email = email
+        self.updated = 0
+        self.etag = None
+        # the events could not be refreshed, and are served as they were
+        self.stale = False
+        # list of (uid, fingerprint, text), in order of start time
+        self._events = list()
+
+    def update(self, meetings: list[dict]):
+        known = {uid: (fingerprint, text) for uid, fingerprint, text in self._events}
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        events = list()
+        for meeting in meetings:
+            uid = meeting_uid(meeting)
+            fingerprint = meeting_fingerprint(meeting)
+            if uid in known and known[uid][0] == fingerprint:
+                text = known[uid][1]
+            else:
+                text = vevent(meeting, now)
+            events.append((uid, fingerprint, text))
+
+        etag = hashlib.sha1()
+        for uid, fingerprint, _ in events:
+            etag.update("{} {}\n".format(uid, fingerprint).encode("utf-8"))
+
+        # replace the list as a whole, so that feeds that are being streamed are not affected
+        self._events = events
+        self.etag = etag.hexdigest()
+        self.updated = time.time()
+        self.stale = False
+
+    def __iter__(self):
+        events = self._events
+        yield "BEGIN:VCALENDAR\r\n"
+        yield "VERSION:2.0\r\n"
+        yield "PRODID:{}\r\n".format(PRODID)
+        yield "CALSCALE:GREGORIAN\r\n"
+        yield "METHOD:PUBLISH\r\n"
+        yield _fold("X-WR-CALNAME:{}".format(_escape(self.email)))
+        for _, _, text in events:
+            yield text
+        yield "END:VCALENDAR\r\n"
+
+
+class IcsFeedCache:
+    def __init__(
+        self,
+        agenda,
+        ttl=None,
+        days_before=DEFAULT_DAYS_BEFORE,
+        days_after=DEFAULT_DAYS_AFTER,
+        cache_size=DEFAULT_CACHE_SIZE,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.agenda = agenda
+        self.ttl = float(ttl) if ttl is not None else agenda.agenda_ttl
+        self.days_before = days_before
+        self.days_after = days_after
+        self.cache_size = int(cache_size)
+        # least recently used first
+        self._feeds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email: str) -> IcsFeed:
+        with self._lock:
+            feed = self._feeds.get(email)
+            if feed is None:
+                feed = self._feeds[email] = IcsFeed(email)
+                while len(self._feeds) > self.cache_size:
+                    self._feeds.popitem(last=False)
+            else:
+                self._feeds.move_to_end(email)
+
+        if time.time() - feed.updated > self.ttl:
+            today = datetime.date.today()
+            try:
+                meetings = self.agenda.get_agenda_for_days(
+                    today - datetime.timedelta(days=self.days_before),
+                    today + datetime.timedelta(days=self.days_after),
+                    email=email,
+                )
+            except Exception as e:
+                # serve the last known events, if we have any
+                if not feed.updated or not is_upstream_failure(e):
+                    raise
+                self.logger.warning("Serving stale feed for %s: %s", email, e)
+                feed.stale = True
+                return feed
+            feed.update(meetings)
+        return feed
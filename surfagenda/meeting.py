@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import dataclasses
+from enum import StrEnum
+
+import exchangelib
+
+
+# see https://learn.microsoft.com/en-us/exchange/client-developer/web-service-reference/myresponsetype
+class ResponseType(StrEnum):
+    UNKNOWN = "Unknown"
+    ORGANIZER = "Organizer"
+    TENTATIVE = "Tentative"
+    ACCEPT = "Accept"
+    DECLINE = "Decline"
+    NORESPONSE = "NoResponseReceived"
+
+
+# see https://learn.microsoft.com/en-us/graph/api/resources/responsestatus
+GRAPH_RESPONSE_TYPES = {
+    "none": ResponseType.UNKNOWN,
+    "organizer": ResponseType.ORGANIZER,
+    "tentativelyAccepted": ResponseType.TENTATIVE,
+    "accepted": ResponseType.ACCEPT,
+    "declined": ResponseType.DECLINE,
+    "notResponded": ResponseType.NORESPONSE,
+}
+
+
+@dataclasses.dataclass
+class Attendee:
+    name: str|None = None
+    email: str|None = None
+    response: ResponseType = ResponseType.UNKNOWN
+
+    @staticmethod
+    def from_ews(ews_attendee: exchangelib.Attendee):
+        return Attendee(
+            name=ews_attendee.mailbox.name,
+            email=ews_attendee.mailbox.email_address,
+            response=ResponseType(ews_attendee.response_type)
+        )
+
+    @staticmethod
+    def from_graph(graph_attendee: dict):
+        address = graph_attendee.get("emailAddress") or dict()
+        status = graph_attendee.get("status") or dict()
+        return Attendee(
+            name=address.get("name"),
+            email=address.get("address"),
+            response=GRAPH_RESPONSE_TYPES.get(status.get("response"), ResponseType.UNKNOWN),
+        )
+
+    def __hash__(self):
+        return hash(self.email)
+
+    def __eq__(self, other):
+        return self.email == other.email
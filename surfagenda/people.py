@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import exchangelib.errors
+import requests
+
+from .backends import GraphServerError
+from .breaker import is_upstream_failure
+from .scheduler import Priority
+
+# Cached directory of people (mailboxes), used to turn whatever ends up in a URL into a proper email address before
+# we ask Exchange for an agenda, and for name-prefix search (autocomplete).
+#
+# Addresses are looked up with EWS ResolveNames the first time they are seen; both hits and misses are cached, so
+# unknown mailboxes are rejected without another round trip. Optionally, the whole directory is loaded in bulk from
+# Microsoft Graph (with the User.ReadBasic.All scope we already request). People we meet as attendees in agendas
+# are remembered as well.
+
+DEFAULT_DOMAIN = "surfnet.nl"
+DEFAULT_PEOPLE_TTL = 24 * 3600  # seconds
+DEFAULT_NEGATIVE_TTL = 600  # seconds
+NEGATIVE_CACHE_SIZE = 10000  # number of unknown addresses to remember
+GRAPH_USERS_PATH = "/users?$select=displayName,mail,userPrincipalName&$top=999"
+
+
+class PeopleResolver:
+    def __init__(
+        self,
+        agenda,
+        domain=DEFAULT_DOMAIN,
+        ttl=DEFAULT_PEOPLE_TTL,
+        negative_ttl=DEFAULT_NEGATIVE_TTL,
+        graph=False,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.agenda = agenda
+        self.domain = domain.lower()
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self.graph = graph
+
+        self._lock = threading.Lock()
+        self._people = dict()  # email -> {"email", "name", "updated"}
+        self._aliases = dict()  # normalised alias -> email
+        # normalised address -> time it was found not to exist, oldest first; these come straight from URLs, so
+        # the number of them is capped
+        self._unknown = OrderedDict()
+        self._graph_loaded = 0
+        self._graph_tried = 0
+
+        # sorted list of (search key, email), rebuilt when it is needed after people were added
+        self._index = list()
+        self._index_dirty = False
+
+    def normalise(self, address: str) -> str:
+        address = address.strip().lower()
+        if address.startswith("<") and address.endswith(">"):
+            address = address[1:-1]
+        for prefix in ("mailto:", "smtp:"):
+            if address.startswith(prefix):
+                address = address[len(prefix) :]
+        if "@" not in address:
+            address = "{}@{}".format(address, self.domain)
+        return address
+
+    def _add(self, email: str, name: str | None, aliases=(), updated=None):
+        # needs to be called with the lock held
+        email = email.lower()
+        person = self._people.get(email)
+        if person is None:
+            person = self._people[email] = {"email": email, "name": name}
+            self._index_dirty = True
+        elif name and person["name"] != name:
+            person["name"] = name
+            self._index_dirty = True
+        person["updated"] = updated if updated is not None else time.time()
+        for alias in (email, *aliases):
+            if alias:
+                self._aliases[alias.lower()] = email
+                self._unknown.pop(alias.lower(), None)
+
+    def _cached(self, address: str) -> str | None:
+        # returns the email address for a known alias, raises for known unknowns, and returns None otherwise
+        now = time.time()
+        with self._lock:
+            email = self._aliases.get(address)
+            if email is not None and now - self._people[email]["updated"] < self.ttl:
+                return email
+            unknown = self._unknown.get(address)
+            if unknown is not None:
+                if now - unknown < self.negative_ttl:
+                    raise exchangelib.errors.ErrorNonExistentMailbox("Mailbox does not exist: {}".format(address))
+                del self._unknown[address]
+        return None
+
+    def _add_unknown(self, address: str):
+        # needs to be called with the lock held
+        now = time.time()
+        self._unknown.pop(address, None)
+        self._unknown[address] = now
+        # entries are in order of time, so expired ones are at the front
+        while self._unknown:
+            oldest, found = next(iter(self._unknown.items()))
+            if now - found < self.negative_ttl and len(self._unknown) <= NEGATIVE_CACHE_SIZE:
+                break
+            del self._unknown[oldest]
+
+    # Returns the primary email address of a mailbox, or raises ErrorNonExistentMailbox
+    def resolve(self, address: str, priority: Priority = Priority.INTERACTIVE) -> str:
+        self._load_graph_if_needed()
+        address = self.normalise(address)
+        email = self._cached(address)
+        if email is not None:
+            return email
+
+        # rooms are known without asking, if we have the room list already
+        rooms = self.agenda._rooms["data"]
+        room = rooms.by_email(address) if rooms is not None else None
+        if room is not None:
+            with self._lock:
+                self._add(room["email"], room["description"])
+            return room["email"]
+
+        try:
+            mailbox = self._resolve_names(address, priority)
+        except Exception as e:
+            if not is_upstream_failure(e):
+                raise
+            # don't turn a hiccup of the directory into a missing mailbox; just use the address as it is
+            self.logger.warning("Could not resolve %s, using it as is: %s", address, e)
+            return address
+
+        with self._lock:
+            if mailbox is None:
+                self._add_unknown(address)
+            else:
+                self._add(mailbox.email_address, mailbox.name, aliases=[address])
+        if mailbox is None:
+            raise exchangelib.errors.ErrorNonExistentMailbox("Mailbox does not exist: {}".format(address))
+        return mailbox.email_address.lower()
+
+    def _resolve_names(self, address: str, priority: Priority):
+        account = self.agenda._get_account()
+        results = self.agenda._ews(
+            lambda: account.protocol.resolve_names([address]), priority=priority, endpoint="directory"
+        )
+        mailboxes = [r for r in results if not isinstance(r, Exception) and r.email_address]
+        if len(mailboxes) == 1:
+            return mailboxes[0]
+        # ambiguous: only accept an exact match
+        return next((m for m in mailboxes if m.email_address.lower() == address), None)
+
+    # remember the people we see in agendas, so they can be found without asking Exchange
+    def learn(self, attendees):
+        now = time.time()
+        with self._lock:
+            for attendee in attendees:
+                if attendee.email and "@" in attendee.email:
+                    self._add(attendee.email, attendee.name, updated=now)
+
+    def _load_graph_if_needed(self):
+        now = time.time()
+        if self.graph and now - self._graph_loaded > self.ttl and now - self._graph_tried > self.negative_ttl:
+            self._graph_tried = now
+            self.agenda._refresh_in_background(("people",), self.load_graph)
+
+    # bulk load the whole directory from Microsoft Graph; pages are fetched through the scheduler and the circuit
+    # breaker of the directory, like the EWS calls
+    def load_graph(self, priority: Priority = Priority.BACKGROUND):
+        users = list()
+        url = self.agenda.graph_url + GRAPH_USERS_PATH
+        while url:
+            data = self.agenda._ews(self._get_graph_page, url, priority=priority, endpoint="directory")
+            users.extend(data.get("value", ()))
+            url = data.get("@odata.nextLink")
+
+        now = time.time()
+        with self._lock:
+            for user in users:
+                email = user.get("mail") or user.get("userPrincipalName")
+                if email:
+                    self._add(email, user.get("displayName"), aliases=[user.get("userPrincipalName")], updated=now)
+            self._graph_loaded = now
+        self.logger.info("Loaded %d people from Graph", len(users))
+
+    def _get_graph_page(self, url: str) -> dict:
+        token = self.agenda.get_graph_token()["access_token"]
+        response = requests.get(
+            url, headers={"Authorization": "Bearer {}".format(token)}, timeout=self.agenda.ews_timeout
+        )
+        if response.status_code in (429, 503):
+            back_off = float(response.headers.get("Retry-After", 0)) or None
+            raise exchangelib.errors.ErrorServerBusy("Graph is throttling us", back_off=back_off)
+        if response.status_code >= 500:
+            raise GraphServerError(response.status_code, response.reason)
+        response.raise_for_status()
+        return response.json()
+
+    def _search_index(self) -> list:
+        with self._lock:
+            if self._index_dirty:
+                index = list()
+                for email, person in self._people.items():
+                    keys = {email, email.split("@")[0]}
+                    if person["name"]:
+                        name = person["name"].lower()
+                        keys.add(name)
+                        keys.update(name.split())
+                    index.extend((key, email) for key in keys)
+                index.sort()
+                self._index = index
+                self._index_dirty = False
+            return self._index
+
+    # people whose name, any part of their name, or email address starts with `prefix`
+    def search(self, prefix: str, limit: int = 10) -> list[dict]:
+        self._load_graph_if_needed()
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return list()
+
+        index = self._search_index()
+        found = dict()
+        i = bisect.bisect_left(index, (prefix, ""))
+        while i < len(index) and index[i][0].startswith(prefix) and len(found) < limit:
+            email = index[i][1]
+            if email not in found:
+                person = self._people[email]
+                found[email] = {"email": email, "name": person["name"]}
+            i += 1
+        return sorted(found.values(), key=lambda p: ((p["name"] or p["email"]).lower(), p["email"]))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"people": len(self._people), "aliases": len(self._aliases), "unknown": len(self._unknown)}
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import cProfile
+import functools
+import logging
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+# Opt-in profiling of a running SurfAgenda.
+#
+# Nothing in here is active unless a Profiler is created and attached: the hot paths of a SurfAgenda instance are
+# only wrapped by instrument(), and requests are only profiled when the caller asks for it. That way, profiling
+# has no overhead at all when it is disabled.
+
+HOT_PATHS = ("get_agenda", "get_availability", "_fetch_rooms")
+DEFAULT_TOP = 30
+
+
+class Profiler:
+    def __init__(self, sample_rate=0.0, top=DEFAULT_TOP, trace_memory=False):
+        self.logger = logging.getLogger(__name__)
+        self.sample_rate = float(sample_rate)
+        self.top = int(top)
+
+        self._lock = threading.Lock()
+        self._timings = dict()  # name -> {"calls", "errors", "total", "max"}
+        self._stats = dict()  # key -> (number of samples, pstats.Stats)
+
+        # only one cProfile profiler can be active at a time, so requests are profiled one by one
+        self._profiling = threading.Lock()
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # wrap the hot paths of `obj` (on the instance only) to keep track of how often they run, and how long they take
+    def instrument(self, obj, names=HOT_PATHS):
+        for name in names:
+            setattr(obj, name, self._timed(name, getattr(obj, name)))
+        return obj
+
+    def _timed(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            failed = False
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self._record(name, time.perf_counter() - start, failed)
+
+        return wrapper
+
+    def _record(self, name, duration, failed):
+        with self._lock:
+            timing = self._timings.setdefault(name, {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0})
+            timing["calls"] += 1
+            timing["errors"] += failed
+            timing["total"] += duration
+            timing["max"] = max(timing["max"], duration)
+
+    # start profiling the current request, if it is forced or sampled, and no other request is being profiled;
+    # returns the profile, or None
+    def start(self, force=False):
+        if not force and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return None
+        if not self._profiling.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiling tool is active
+            self._profiling.release()
+            return None
+        return profile
+
+    def stop(self, profile, key):
+        if profile is None:
+            return
+        try:
+            profile.disable()
+        finally:
+            self._profiling.release()
+
+        with self._lock:
+            samples, stats = self._stats.get(key, (0, None))
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self._stats[key] = (samples + 1, stats)
+
+    def _top_functions(self, stats: pstats.Stats) -> list[dict]:
+        functions = list()
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            functions.append(
+                {
+                    "function": "{}:{}({})".format(Path(filename).name, line, function),
+                    "calls": calls,
+                    "own": round(own, 6),
+                    "cumulative": round(cumulative, 6),
+                }
+            )
+        functions.sort(key=lambda f: f["cumulative"], reverse=True)
+        return functions[: self.top]
+
+    def memory(self, agenda=None) -> dict:
+        data = dict()
+        if agenda is not None:
+            data["caches"] = agenda.cache_sizes()
+        if not tracemalloc.is_tracing():
+            data["tracemalloc"] = None
+            return data
+
+        # allocations that are still alive, by the line in SurfAgenda that made them
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(True, str(Path(__file__).parent / "*")), tracemalloc.Filter(False, __file__)]
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        top = list()
+        for stat in snapshot.statistics("lineno")[: self.top]:
+            frame = stat.traceback[0]
+            line = "{}:{}".format(Path(frame.filename).name, frame.lineno)
+            top.append({"line": line, "size": stat.size, "count": stat.count})
+        data["tracemalloc"] = {"current": current, "peak": peak, "top": top}
+        return data
+
+    def stats(self, agenda=None) -> dict:
+        with self._lock:
+            timings = {name: dict(timing) for name, timing in self._timings.items()}
+            requests = {
+                str(key): {"samples": samples, "functions": self._top_functions(stats)}
+                for key, (samples, stats) in self._stats.items()
+            }
+
+        for timing in timings.values():
+            timing["mean"] = timing["total"] / timing["calls"] if timing["calls"] else 0.0
+        return {
+            "sample_rate": self.sample_rate,
+            "hot_paths": timings,
+            "requests": requests,
+            "memory": self.memory(agenda),
+        }
+
+    def reset(self):
+        with self._lock:
+            self._timings = dict()
+            self._stats = dict()
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import calendar
+import datetime
+import itertools
+
+from exchangelib.fields import WEEKDAYS
+from exchangelib.recurrence import (
+    AbsoluteMonthlyPattern,
+    AbsoluteYearlyPattern,
+    DailyPattern,
+    EndDatePattern,
+    NumberedPattern,
+    RelativeMonthlyPattern,
+    RelativeYearlyPattern,
+    WeeklyPattern,
+)
+
+# Local expansion of EWS recurrence patterns, so that we only need to fetch the recurring master items once,
+# instead of having the server expand (and send) every single occurrence for every requested date range.
+# See https://learn.microsoft.com/en-us/exchange/client-developer/exchange-web-services/recurrence-patterns-and-ews
+
+# special values for the weekday of relative patterns ("first weekday of the month", etc)
+DAY = 8
+WEEK_DAY = 9
+WEEKEND_DAY = 10
+LAST_WEEK = 5
+
+
+def _weekday(value) -> int:
+    # exchangelib converts these enums to ISO numbers (1 is Monday), but be lenient with the names as well
+    if isinstance(value, str):
+        return WEEKDAYS.index(value) + 1
+    return int(value)
+
+
+def _localize(tz: datetime.tzinfo, dt: datetime.datetime) -> datetime.datetime:
+    # pytz timezones can't be passed as tzinfo directly
+    if hasattr(tz, "localize"):
+        return tz.localize(dt)
+    return dt.replace(tzinfo=tz)
+
+
+def _add_months(year: int, month: int, months: int) -> tuple[int, int]:
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+
+def _day_of_month(year: int, month: int, day: int) -> datetime.date:
+    # if the month is too short, the last day of the month is used
+    return datetime.date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def _nth_weekday(year: int, month: int, weekday: int, week_number: int) -> datetime.date:
+    days = [datetime.date(year, month, d) for d in range(1, calendar.monthrange(year, month)[1] + 1)]
+    if weekday == DAY:
+        candidates = days
+    elif weekday == WEEK_DAY:
+        candidates = [d for d in days if d.isoweekday() <= 5]
+    elif weekday == WEEKEND_DAY:
+        candidates = [d for d in days if d.isoweekday() > 5]
+    else:
+        candidates = [d for d in days if d.isoweekday() == weekday]
+
+    if week_number >= LAST_WEEK:
+        return candidates[-1]
+    return candidates[week_number - 1]
+
+
+# generate all dates of the pattern, in order, starting at the start of the series.
+# `skip_to` is a hint that dates before it are not needed; it is only safe to use if occurrences don't need to be
+# counted from the start of the series
+def _dates(pattern, start: datetime.date, skip_to: datetime.date | None = None):
+    if isinstance(pattern, DailyPattern):
+        first = 0
+        if skip_to is not None and skip_to > start:
+            first = (skip_to - start).days // pattern.interval
+        for n in itertools.count(first):
+            yield start + datetime.timedelta(days=n * pattern.interval)
+
+    elif isinstance(pattern, WeeklyPattern):
+        weekdays = sorted(_weekday(d) for d in pattern.weekdays)
+        first_day_of_week = _weekday(pattern.first_day_of_week)
+        week_start = start - datetime.timedelta(days=(start.isoweekday() - first_day_of_week) % 7)
+        first = 0
+        if skip_to is not None and skip_to > week_start:
+            first = (skip_to - week_start).days // 7 // pattern.interval
+        for n in itertools.count(first):
+            this_week = week_start + datetime.timedelta(weeks=n * pattern.interval)
+            days = (this_week + datetime.timedelta(days=i) for i in range(7))
+            for day in days:
+                if day >= start and day.isoweekday() in weekdays:
+                    yield day
+
+    elif isinstance(pattern, (AbsoluteMonthlyPattern, RelativeMonthlyPattern)):
+        first = 0
+        if skip_to is not None and skip_to > start:
+            months = (skip_to.year - start.year) * 12 + skip_to.month - start.month
+            first = max(0, months // pattern.interval - 1)
+        for n in itertools.count(first):
+            year, month = _add_months(start.year, start.month, n * pattern.interval)
+            if isinstance(pattern, AbsoluteMonthlyPattern):
+                day = _day_of_month(year, month, pattern.day_of_month)
+            else:
+                day = _nth_weekday(year, month, _weekday(pattern.weekday), int(pattern.week_number))
+            if day >= start:
+                yield day
+
+    elif isinstance(pattern, (AbsoluteYearlyPattern, RelativeYearlyPattern)):
+        first = start.year
+        if skip_to is not None and skip_to.year > start.year:
+            first = skip_to.year - 1
+        for year in itertools.count(first):
+            if isinstance(pattern, AbsoluteYearlyPattern):
+                day = _day_of_month(year, int(pattern.month), pattern.day_of_month)
+            else:
+                day = _nth_weekday(year, int(pattern.month), _weekday(pattern.weekday), int(pattern.week_number))
+            if day >= start:
+                yield day
+
+    else:
+        raise NotImplementedError("Unsupported recurrence pattern {}".format(type(pattern).__name__))
+
+
+# exchangelib makes the end date of all-day items inclusive, but they last until the end of that day
+def _all_day_extra(item) -> datetime.timedelta:
+    if isinstance(item.start, datetime.datetime):
+        return datetime.timedelta(0)
+    return datetime.timedelta(days=1)
+
+
+def _as_datetime(t, tz: datetime.tzinfo) -> datetime.datetime:
+    if isinstance(t, datetime.datetime):
+        return t
+    return _localize(tz, datetime.datetime.combine(t, datetime.time.min))
+
+
+# yields (start, end) of all occurrences of the recurring master item that overlap the window.
+# For all-day items, end is the (inclusive) start of the last day, like exchangelib returns it for single items.
+# Deleted and modified occurrences are not taken into account here; see occurrences() for that.
+def expand(
+    master,
+    window_start: datetime.datetime,
+    window_stop: datetime.datetime,
+    tz: datetime.tzinfo,
+):
+    recurrence = master.recurrence
+    pattern, boundary = recurrence.pattern, recurrence.boundary
+
+    duration = master.end - master.start
+    extra = _all_day_extra(master)
+    if isinstance(master.start, datetime.datetime):
+        # expand in the timezone the meeting was created in, so that occurrences keep their wall-clock time
+        # across DST changes
+        tz = getattr(master, "_start_timezone", None) or tz
+        time_of_day = master.start.astimezone(tz).time().replace(tzinfo=None)
+    else:
+        # all-day items
+        time_of_day = datetime.time.min
+
+    skip_to = None
+    if not isinstance(boundary, NumberedPattern):
+        skip_to = (window_start - duration - extra).date() - datetime.timedelta(days=1)
+
+    for count, day in enumerate(_dates(pattern, boundary.start, skip_to)):
+        if isinstance(boundary, NumberedPattern) and count >= boundary.number:
+            return
+        if isinstance(boundary, EndDatePattern) and day > boundary.end:
+            return
+
+        naive_start = datetime.datetime.combine(day, time_of_day)
+        start = _localize(tz, naive_start)
+        end = _localize(tz, naive_start + duration)
+        if start >= window_stop:
+            return
+        if end + extra > window_start:
+            yield start, end
+
+
+# yields (item, start, end) for all occurrences of the recurring master item that overlap the window.
+# Deleted occurrences are left out, and modified occurrences are replaced by their exception items from `exceptions`
+# (by item id); those keep their own start and end, so start and end are None for them.
+def occurrences(
+    master,
+    exceptions: dict,
+    window_start: datetime.datetime,
+    window_stop: datetime.datetime,
+    tz: datetime.tzinfo,
+):
+    # deleted and modified occurrences are identified by their original start time
+    deleted = set(o.start for o in (master.deleted_occurrences or []))
+    modified = set(o.original_start for o in (master.modified_occurrences or []))
+
+    for start, end in expand(master, window_start, window_stop, tz):
+        if start in deleted or start in modified:
+            continue
+        yield master, start, end
+
+    # modified occurrences might have been moved into (or out of) the window
+    for occurrence in master.modified_occurrences or []:
+        item = exceptions.get(occurrence.id)
+        if item is None:
+            continue
+        start = _as_datetime(item.start, tz)
+        end = _as_datetime(item.end, tz) + _all_day_extra(item)
+        if start < window_stop and end > window_start:
+            yield item, None, None
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import bisect
+
+# The room directory: all rooms by number, as returned by SurfAgenda._fetch_rooms(), with secondary indexes so that
+# rooms can be looked up by floor, location, type, roomlist group and capacity without scanning all of them.
+#
+# Indexes are built once, when the directory is created; a new directory is created whenever the rooms are
+# fetched again, so the directory should be treated as read-only.
+
+INDEXED = ("floor", "location", "type", "groups")
+
+
+def _sort_key(room: dict):
+    return room["floor"], room["floor_subnum"], room["number"]
+
+
+class RoomDirectory(dict):
+    def __init__(self, rooms: dict | None = None):
+        super().__init__(rooms or dict())
+
+        # all room numbers in display order, and the position of every room in that order
+        self._order = sorted(self, key=lambda number: _sort_key(self[number]))
+        self._rank = {number: i for i, number in enumerate(self._order)}
+
+        self._by_email = {room["email"].lower(): number for number, room in self.items()}
+
+        # field -> value -> room numbers, in display order
+        self._indexes = {field: dict() for field in INDEXED}
+        for number in self._order:
+            room = self[number]
+            for field in INDEXED:
+                values = room[field] if field == "groups" else [room[field]]
+                for value in values:
+                    self._indexes[field].setdefault(self._normalise(value), list()).append(number)
+
+        # sorted (capacity, rank) pairs, for range queries; rooms with unknown capacity are left out
+        self._capacity = sorted(
+            (room["capacity"], self._rank[number]) for number, room in self.items() if room.get("capacity") is not None
+        )
+
+    # indexes are derived data: only pickle the rooms themselves, and rebuild the indexes when unpickling
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    @staticmethod
+    def _normalise(value):
+        return value.lower() if isinstance(value, str) else value
+
+    def by_email(self, email: str) -> dict | None:
+        number = self._by_email.get(email.lower())
+        return self[number] if number is not None else None
+
+    def values_by(self, field: str) -> list:
+        return sorted(self._indexes[field], key=str)
+
+    def _lookup(self, field: str, values) -> list:
+        # room numbers with any of the values, in display order
+        if len(values) == 1:
+            return self._indexes[field].get(self._normalise(values[0]), list())
+        numbers = set()
+        for value in values:
+            numbers.update(self._indexes[field].get(self._normalise(value), ()))
+        return sorted(numbers, key=self._rank.__getitem__)
+
+    def _capacity_range(self, min_people=None, max_people=None) -> list:
+        lo = 0 if min_people is None else bisect.bisect_left(self._capacity, (min_people, -1))
+        hi = len(self._capacity) if max_people is None else bisect.bisect_right(self._capacity, (max_people, len(self)))
+        return [self._order[rank] for rank in sorted(rank for _, rank in self._capacity[lo:hi])]
+
+    def _matches(self, room: dict, criteria: dict, min_people, max_people) -> bool:
+        for field, values in criteria.items():
+            if field == "groups":
+                if not any(self._normalise(group) in values for group in room["groups"]):
+                    return False
+            elif self._normalise(room[field]) not in values:
+                return False
+        capacity = room.get("capacity")
+        if min_people is not None and (capacity is None or capacity < min_people):
+            return False
+        if max_people is not None and (capacity is None or capacity > max_people):
+            return False
+        return True
+
+    # Rooms matching all of the given criteria, in display order (by floor and number). Every field criterion can
+    # be a single value or a list of values, any of which matches; group matches any of the room's roomlists.
+    # Only the smallest candidate list from the indexes is scanned, so the work is proportional to the result
+    # rather than to the size of the directory.
+    def query(self, floor=None, location=None, type=None, group=None, min_people=None, max_people=None) -> list[dict]:
+        criteria = {
+            field: list(value) if isinstance(value, (list, tuple, set)) else [value]
+            for field, value in (("floor", floor), ("location", location), ("type", type), ("groups", group))
+            if value is not None
+        }
+
+        candidates = [self._lookup(field, values) for field, values in criteria.items()]
+        if min_people is not None or max_people is not None:
+            candidates.append(self._capacity_range(min_people, max_people))
+        if not candidates:
+            return [self[number] for number in self._order]
+
+        criteria = {field: {self._normalise(value) for value in values} for field, values in criteria.items()}
+        return [
+            self[number]
+            for number in min(candidates, key=len)
+            if self._matches(self[number], criteria, min_people, max_people)
+        ]
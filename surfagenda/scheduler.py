@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from enum import IntEnum
+
+import exchangelib.errors
+
+
+class Priority(IntEnum):
+    # lower value is served first
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+# Central gate for all EWS calls made through a single account.
+# Office 365 throttles per account, so we keep our own token bucket (to stay below the budget in the first place),
+# honour the back-off hints the server sends along with ErrorServerBusy, and make sure interactive requests
+# jump the queue before background refreshes.
+# Interactive callers are serving a web request, so they never wait out a server back-off longer than
+# max_interactive_wait; they get ErrorServerBusy instead, and the circuit breaker or stale data answers them.
+class EWSScheduler:
+    def __init__(
+        self,
+        rate: float = 5.0,
+        burst: int = 10,
+        max_retries: int = 2,
+        default_back_off: float = 10.0,
+        max_interactive_wait: float = 2.0,
+    ):
+        self.logger = logging.getLogger(__name__)
+
+        self.rate = float(rate)  # tokens per second
+        self.burst = int(burst)  # bucket size
+        self.max_retries = int(max_retries)
+        self.default_back_off = float(default_back_off)
+        self.max_interactive_wait = float(max_interactive_wait)
+
+        self._cond = threading.Condition()
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._back_off_until = 0.0
+
+        # heap of (priority, sequence) tickets of callers waiting for a token
+        self._waiting = list()
+        self._sequence = itertools.count()
+
+        self._counters = {
+            "calls": 0,
+            "failures": 0,
+            "throttled": 0,
+            "rejected": 0,
+            "waited": 0,
+            "wait_time": 0.0,
+        }
+        self._in_flight = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _next_attempt(self, ticket, now: float) -> float | None:
+        # returns 0 if this ticket may go ahead now, the number of seconds to wait otherwise,
+        # or None if we need to wait for another caller to go first
+        if self._waiting[0] != ticket:
+            return None
+        if now < self._back_off_until:
+            return self._back_off_until - now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        return 0
+
+    def _acquire(self, priority: Priority):
+        with self._cond:
+            ticket = (int(priority), next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            t_start = time.monotonic()
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._next_attempt(ticket, now)
+                    if wait == 0:
+                        break
+                    back_off = self._back_off_until - now
+                    if priority == Priority.INTERACTIVE and back_off > self.max_interactive_wait:
+                        self._counters["rejected"] += 1
+                        raise exchangelib.errors.ErrorServerBusy(
+                            "Backing off for another {:.1f}s".format(back_off), back_off=back_off
+                        )
+                    self._cond.wait(timeout=wait)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self._in_flight += 1
+
+            waited = time.monotonic() - t_start
+            if waited > 0.001:
+                self._counters["waited"] += 1
+                self._counters["wait_time"] += waited
+
+            # wake up the next in line
+            self._cond.notify_all()
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+
+    def back_off(self, seconds: float):
+        with self._cond:
+            self._back_off_until = max(self._back_off_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def run(self, func, *args, priority: Priority = Priority.INTERACTIVE, **kwargs):
+        attempt = 0
+        while True:
+            self._acquire(priority)
+            try:
+                with self._cond:
+                    self._counters["calls"] += 1
+                return func(*args, **kwargs)
+            except exchangelib.errors.ErrorServerBusy as e:
+                back_off = e.back_off or self.default_back_off
+                self.logger.warning("EWS server busy, backing off for %.1fs (attempt %d)", back_off, attempt + 1)
+                with self._cond:
+                    self._counters["throttled"] += 1
+                self.back_off(back_off)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+            except Exception:
+                with self._cond:
+                    self._counters["failures"] += 1
+                raise
+            finally:
+                self._release()
+
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            queued = {p.name.lower(): 0 for p in Priority}
+            for prio, _ in self._waiting:
+                queued[Priority(prio).name.lower()] += 1
+            return {
+                "queued": queued,
+                "in_flight": self._in_flight,
+                "tokens": round(self._tokens, 2),
+                "rate": self.rate,
+                "burst": self.burst,
+                "back_off": round(max(0.0, self._back_off_until - now), 1),
+                **self._counters,
+            }
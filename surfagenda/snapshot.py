@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from pathlib import Path
+
+# On-disk snapshots of the SurfAgenda caches, used to survive restarts without hitting Exchange for everything.
+#
+# File layout:
+#   MAGIC | offset of index (8 bytes, big endian) | blob | blob | ... | index
+# Every blob is a zlib-compressed pickle; the index maps keys to (offset, length) of their blob. When loading, only
+# the index is decoded; the file is memory-mapped and blobs are decoded when they are first needed.
+
+MAGIC = b"SURFSNAP1\n"
+HEADER = struct.Struct(">Q")
+
+
+class SnapshotWriter:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        self._file = None
+        self._index = dict()
+
+    def __enter__(self):
+        self._file = open(self._tmp, "wb")
+        os.chmod(self._tmp, 0o600)
+        self._file.write(MAGIC)
+        self._file.write(HEADER.pack(0))
+        return self
+
+    def add(self, key, value):
+        blob = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        self._index[key] = (self._file.tell(), len(blob))
+        self._file.write(blob)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                index_offset = self._file.tell()
+                self._file.write(zlib.compress(pickle.dumps(self._index, protocol=pickle.HIGHEST_PROTOCOL)))
+                self._file.seek(len(MAGIC))
+                self._file.write(HEADER.pack(index_offset))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+
+        if exc_type is None:
+            # atomically replace the old snapshot; readers that still have it mapped keep seeing the old one
+            os.replace(self._tmp, self.path)
+        else:
+            self._tmp.unlink(missing_ok=True)
+
+
+class Snapshot:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[: len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a snapshot file".format(self.path))
+        (index_offset,) = HEADER.unpack_from(self._map, len(MAGIC))
+        self._index = pickle.loads(zlib.decompress(self._map[index_offset:]))
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, key, default=None):
+        if key not in self._index:
+            return default
+        offset, length = self._index[key]
+        return pickle.loads(zlib.decompress(self._map[offset : offset + length]))
+
+
+# cache entry whose data is only decoded from the snapshot when it is used
+class LazyEntry(dict):
+    def __init__(self, snapshot: Snapshot, key, **fields):
+        super().__init__(**fields)
+        self._snapshot = snapshot
+        self._key = key
+
+    def __missing__(self, name):
+        if name != "data":
+            raise KeyError(name)
+        data = self["data"] = self._snapshot.get(self._key)
+        return data
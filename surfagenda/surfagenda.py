@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 from __future__ import annotations
 
+import atexit
+import concurrent.futures
 import dataclasses
+import hashlib
+import itertools
 import sys
-from enum import Enum, StrEnum
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
-from pprint import pprint
 import logging
 import datetime
 import dateutil.parser
@@ -15,25 +19,34 @@ import time
 import jwt
 import pytz
 import json
+import pickle
+import random
 import re
+import zlib
 
 import msal, msal.authority
 import platformdirs
 
-import exchangelib
+import exchangelib.errors
 from exchangelib import (
     Configuration,
     OAUTH2,
     Account,
     OAuth2AuthorizationCodeCredentials,
+    OAuth2Credentials,
+    Identity,
     DELEGATE,
+    IMPERSONATION,
 )
+from exchangelib.protocol import Protocol
 
-
-
-# from http://stackoverflow.com/questions/9868653/find-first-sequence-item-that-matches-a-criterium
-def findfirst(items, pred):
-    return next((i for i in enumerate(items) if pred(i[1])), (None, None))
+from .backends import GRAPH_CALENDAR_SCOPE, DEFAULT_GRAPH_URL, EWSBackend, GraphBackend
+from .breaker import CircuitBreaker, UpstreamTransportError, is_upstream_failure
+from .meeting import Attendee, ResponseType
+from .people import DEFAULT_DOMAIN, DEFAULT_NEGATIVE_TTL, DEFAULT_PEOPLE_TTL, PeopleResolver
+from .rooms import RoomDirectory
+from .scheduler import EWSScheduler, Priority
+from .snapshot import LazyEntry, Snapshot, SnapshotWriter
 
 
 class JSONAgendaEncoder(json.JSONEncoder):
@@ -42,10 +55,36 @@ class JSONAgendaEncoder(json.JSONEncoder):
             return o.isoformat()
         elif isinstance(o, datetime.date):
             return o.strftime("%Y-%m-%d")
+        elif isinstance(o, datetime.timedelta):
+            return int(o.total_seconds())
+        elif dataclasses.is_dataclass(o):
+            return dataclasses.asdict(o)
+        elif isinstance(o, (set, frozenset)):
+            # sort to get a stable representation
+            return sorted(o, key=repr)
         else:
             return json.JSONEncoder.default(self, o)
 
 
+# config values arrive as strings
+def _as_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "yes", "true", "on")
+    return bool(value)
+
+
+# the changekey changes whenever the item changes; locally expanded occurrences share the changekey of their
+# master, but have their own start time
+def meeting_fingerprint(meeting: dict) -> str:
+    return "{}/{}".format(meeting["changekey"], meeting["start"].isoformat())
+
+
+# stable fingerprint of a piece of (agenda or room) data, used as its version
+def data_digest(data) -> str:
+    serialized = json.dumps(data, sort_keys=True, separators=(",", ":"), cls=JSONAgendaEncoder)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
 DEFAULT_CLIENT_ID = "9e5f94bc-e8a4-4e73-b8be-63364c29d753"  # thunderbird client_id
 DEFAULT_TIMEZONE = "Europe/Amsterdam"
 DEFAULT_CACHE_FILE = Path(platformdirs.user_cache_dir()) / Path("net.zoetekouw.surfchange.tokens.bin")
@@ -57,38 +96,20 @@ DEFAULT_EXCHANGE_SCOPE = [
 ]
 DEFAULT_GRAPH_SCOPE = ["User.Read", "User.ReadBasic.All"]
 DEFAULT_EWS_SERVER = "outlook.office.com"
-
-
-# see https://learn.microsoft.com/en-us/exchange/client-developer/web-service-reference/myresponsetype
-class ResponseType(StrEnum):
-    UNKNOWN = "Unknown"
-    ORGANIZER = "Organizer"
-    TENTATIVE = "Tentative"
-    ACCEPT = "Accept"
-    DECLINE = "Decline"
-    NORESPONSE = "NoResponseReceived"
-
-
-
-@dataclasses.dataclass
-class Attendee:
-    name: str|None = None
-    email: str|None = None
-    response: ResponseType = ResponseType.UNKNOWN
-
-    @staticmethod
-    def from_ews(ews_attendee: exchangelib.Attendee):
-        return Attendee(
-            name=ews_attendee.mailbox.name,
-            email=ews_attendee.mailbox.email_address,
-            response=ResponseType(ews_attendee.response_type)
-        )
-
-    def __hash__(self):
-        return hash(self.email)
-
-    def __eq__(self, other):
-        return self.email == other.email
+DEFAULT_TENANT = "surf.nl"
+# app-only tokens carry the application permissions that were granted to the app, not individual scopes
+APP_EXCHANGE_SCOPE = ["https://outlook.office365.com/.default"]
+APP_GRAPH_SCOPE = ["https://graph.microsoft.com/.default"]
+APP_EWS_SERVER = "outlook.office365.com"
+DEFAULT_AGENDA_TTL = 60  # seconds
+DEFAULT_AGENDA_CACHE_SIZE = 1000  # number of (mailbox, day) entries
+ACCOUNT_CACHE_SIZE = 256  # number of mailboxes to keep EWS accounts (and their sessions) for
+DEFAULT_CHANGE_LOG_SIZE = 50  # changes kept per (mailbox, day) for delta responses
+VERSION_TAGS = 1000  # versions end in a random per-process tag, so processes don't issue the same versions
+DEFAULT_RECURRENCE_TTL = 300  # seconds before checking recurring masters for changes
+DEFAULT_EWS_TIMEOUT = 10  # seconds
+DEFAULT_BREAKER_THRESHOLD = 5  # consecutive failures before a circuit opens
+DEFAULT_BREAKER_RESET = 30  # seconds before trying again
 
 
 # token cache that automatically saves to file on changes
@@ -128,15 +149,46 @@ class SurfAgenda:
     def __init__(
         self,
         client_id=DEFAULT_CLIENT_ID,
+        client_secret=None,
+        tenant_id=DEFAULT_TENANT,
+        email=None,
         cache_file=DEFAULT_CACHE_FILE,
         tz=DEFAULT_TIMEZONE,
+        scheduler: EWSScheduler | None = None,
+        agenda_ttl=DEFAULT_AGENDA_TTL,
+        agenda_cache_size=DEFAULT_AGENDA_CACHE_SIZE,
+        change_log_size=DEFAULT_CHANGE_LOG_SIZE,
+        expand_recurrence=False,
+        recurrence_ttl=DEFAULT_RECURRENCE_TTL,
+        snapshot_file=None,
+        snapshot_interval=0,
+        ews_timeout=DEFAULT_EWS_TIMEOUT,
+        breaker_threshold=DEFAULT_BREAKER_THRESHOLD,
+        breaker_reset=DEFAULT_BREAKER_RESET,
+        utilisation_dir=None,
+        mail_domain=DEFAULT_DOMAIN,
+        people_ttl=DEFAULT_PEOPLE_TTL,
+        people_negative_ttl=DEFAULT_NEGATIVE_TTL,
+        people_graph=False,
+        backend="ews",
+        graph_url=DEFAULT_GRAPH_URL,
     ):
         self.logger = logging.getLogger(__name__)
         self.logger.debug("Initializing SurfAgenda")
 
-        self._email = None
+        self._email = email.lower() if email else None
         self.client_id = client_id
+        self.tenant_id = tenant_id
         self.scopes = DEFAULT_EXCHANGE_SCOPE + DEFAULT_GRAPH_SCOPE
+        self.graph_scope = DEFAULT_GRAPH_SCOPE
+
+        # With a client secret, we run as a confidential client with app-only tokens, and access every mailbox
+        # through impersonation; `email` is the mailbox used for directory lookups. Otherwise, we act on behalf of
+        # a single user, who logs in with the device code flow.
+        self.client_secret = client_secret
+        self.app_only = bool(client_secret)
+        if self.app_only and not self._email:
+            raise ValueError("App-only access needs the email address of a service mailbox")
 
         self.tz = pytz.timezone(tz)
 
@@ -148,14 +200,98 @@ class SurfAgenda:
 
         self._msal_app = self._get_msal_app()
         self.credentials = None
+        # EWS accounts per mailbox, with their credentials
+        self._accounts = OrderedDict()
+
+        self._rooms = {"updated": 0, "data": None, "digest": None}
+
+        # agendas per (email, day), kept for a short while to serve repeated page views
+        self.agenda_ttl = float(agenda_ttl)
+        self.agenda_cache_size = int(agenda_cache_size)
+        self._agendas = OrderedDict()
+        self._lock = threading.Lock()
+        self.change_log_size = int(change_log_size)
+        self._versions = itertools.count(time.time_ns() // 1_000_000)
+        self._version_tag = random.randrange(VERSION_TAGS)
+
+        # with the EWS backend, recurring meetings can be expanded locally instead of on the server
+        self.expand_recurrence = _as_bool(expand_recurrence)
+        self.recurrence_ttl = float(recurrence_ttl)
+
+        # all EWS calls go through the scheduler, to stay within our throttling budget; with impersonation every
+        # mailbox has a budget of its own, so then there is a scheduler per mailbox as well
+        self.scheduler = scheduler if scheduler is not None else EWSScheduler()
+        self._schedulers = dict()
+
+        # fail fast when Exchange is in trouble: tight timeouts, and a circuit breaker per kind of EWS call
+        self.ews_timeout = float(ews_timeout)
+        self.breakers = {
+            endpoint: CircuitBreaker(endpoint, failure_threshold=breaker_threshold, reset_timeout=breaker_reset)
+            for endpoint in ("calendar", "directory")
+        }
+
+        # Microsoft Graph is also used for bulk loading the people directory, when enabled
+        self.graph_url = graph_url.rstrip("/")
+
+        # Where calendar data comes from: EWS, or Microsoft Graph, which can batch requests for many mailboxes.
+        # Rooms and name resolution always use EWS.
+        if backend == "graph":
+            self.backend = GraphBackend(self, base_url=graph_url)
+            if not self.app_only:
+                self.graph_scope = DEFAULT_GRAPH_SCOPE + GRAPH_CALENDAR_SCOPE
+                self.scopes = DEFAULT_EXCHANGE_SCOPE + self.graph_scope
+        elif backend == "ews":
+            self.backend = EWSBackend(self)
+        else:
+            raise ValueError("Unknown calendar backend: {}".format(backend))
+
+        # last known status per email, as computed by get_availability
+        self._status = dict()
 
-        self._rooms = {"updated": 0, "data": None}
+        # keys of cache entries that are being refreshed in the background
+        self._refreshing = set()
 
-    def _get_msal_app(self) -> msal.PublicClientApplication:
+        # cached directory of mailboxes, to resolve addresses and search for people by name
+        self.people = PeopleResolver(
+            self, domain=mail_domain, ttl=people_ttl, negative_ttl=people_negative_ttl, graph=_as_bool(people_graph)
+        )
+
+        # history of room bookings, for utilisation statistics; needs numpy, so only imported when enabled
+        self.utilisation = None
+        if utilisation_dir:
+            from .utilisation import UtilisationStore
+
+            self.utilisation = UtilisationStore(utilisation_dir)
+            atexit.register(self.utilisation.flush)
+
+        # Snapshots of the caches survive restarts. Entries loaded from a snapshot are marked as stale: they are
+        # served as they are, while being refreshed in the background
+        self.snapshot_file = Path(snapshot_file) if snapshot_file else None
+        if self.snapshot_file is not None:
+            if self.snapshot_file.exists():
+                self.load_snapshot(self.snapshot_file)
+            atexit.register(self.save_snapshot)
+            if float(snapshot_interval) > 0:
+                threading.Thread(
+                    target=self._snapshot_loop,
+                    args=(float(snapshot_interval),),
+                    name="surfagenda-snapshot",
+                    daemon=True,
+                ).start()
+
+    def _get_msal_app(self) -> msal.ClientApplication:
+        authority = "https://login.microsoftonline.com/{}".format(self.tenant_id)
+        if self.app_only:
+            return msal.ConfidentialClientApplication(
+                client_id=self.client_id,
+                client_credential=self.client_secret,
+                authority=authority,
+                token_cache=self._msal_cache,
+            )
         # try to read cache
         app = msal.PublicClientApplication(
             client_id=self.client_id,
-            authority="https://login.microsoftonline.com/surf.nl",
+            authority=authority,
             token_cache=self._msal_cache,
         )
         return app
@@ -169,6 +305,9 @@ class SurfAgenda:
         return self._email
 
     def authenticate(self):
+        if self.app_only:
+            # app-only tokens are requested when needed, there is nobody to log in
+            return
         app = self._msal_app
         accounts = app.get_accounts()
         if not accounts:
@@ -195,11 +334,20 @@ class SurfAgenda:
         self._msal_app = app
 
     def get_token(self, scopes: list[str]):
+        if self.app_only:
+            # msal serves the token from the (shared) cache, and only asks for a new one when it expires
+            token = self._msal_app.acquire_token_for_client(scopes=scopes)
+            if "access_token" not in token:
+                raise ValueError(
+                    "Could not get app-only token: {}: {}".format(token.get("error"), token.get("error_description"))
+                )
+            return token
+
         self.authenticate()
         accounts = self._msal_app.get_accounts()
 
         # fetch the token from cache (and refresh it if necessary)
-        print(
+        self.logger.debug(
             f"Found account for {accounts[0]['username']} in cache. Trying to fetch token silently"
         )
         token = self._msal_app.acquire_token_silent_with_error(
@@ -214,44 +362,134 @@ class SurfAgenda:
         # decode the OIDC id_token to get the user's email address
         algorithm = jwt.get_unverified_header(id_token).get("alg")
         decoded = jwt.decode(id_token, verify=False, options={"verify_signature": False})
-        print("Got token:")
-        print("  - alg: " + algorithm)
-        print("  - aud: " + decoded["aud"])
-        print("  - upn: " + decoded["upn"])
-        print("  - scp: " + decoded["scp"])
+        self.logger.debug("Got token:")
+        self.logger.debug("  - alg: " + algorithm)
+        self.logger.debug("  - aud: " + decoded["aud"])
+        self.logger.debug("  - upn: " + decoded["upn"])
+        self.logger.debug("  - scp: " + decoded["scp"])
 
         return token
     def get_EWS_token(self):
-        return self.get_token(DEFAULT_EXCHANGE_SCOPE)
+        return self.get_token(APP_EXCHANGE_SCOPE if self.app_only else DEFAULT_EXCHANGE_SCOPE)
 
     def get_graph_token(self):
-        return self.get_token(DEFAULT_GRAPH_SCOPE)
+        return self.get_token(APP_GRAPH_SCOPE if self.app_only else self.graph_scope)
 
 
 
 
+    # exchangelib keeps a protocol, with a pool of sessions, for every distinct set of credentials, including the
+    # access token. So accounts and their credentials are reused, and only the token is updated when it changes.
     def _get_account(self, email=None):
         if email is None:
             email = self.email
-
-        # now exchangelib:
-        creds = OAuth2AuthorizationCodeCredentials(access_token=self.get_EWS_token())
-        # creds = OAuth2AuthorizationCodeCredentials( access_token=OAuth2Token({'access_token': token}))
-        conf = Configuration(server=DEFAULT_EWS_SERVER, auth_type=OAUTH2, credentials=creds)
+        key = email.lower()
+        token = self.get_EWS_token()
+
+        with self._lock:
+            cached = self._accounts.get(key)
+            if cached is not None:
+                self._accounts.move_to_end(key)
+        if cached is not None:
+            creds, account = cached
+            if creds.access_token is None or creds.access_token["access_token"] != token["access_token"]:
+                creds.on_token_auto_refreshed(token)
+            return account
+
+        if self.app_only:
+            # the identity is used to impersonate the mailbox in calls that are not tied to the account, like
+            # room lists and name resolution
+            creds = OAuth2Credentials(
+                client_id=self.client_id,
+                client_secret=self.client_secret,
+                tenant_id=self.tenant_id,
+                identity=Identity(primary_smtp_address=email),
+                access_token=token,
+            )
+            conf = Configuration(server=APP_EWS_SERVER, auth_type=OAUTH2, credentials=creds)
+            access_type = IMPERSONATION
+        else:
+            # all mailboxes are accessed with the credentials of the user
+            with self._lock:
+                if self.credentials is None:
+                    self.credentials = OAuth2AuthorizationCodeCredentials(access_token=token)
+                creds = self.credentials
+            if creds.access_token["access_token"] != token["access_token"]:
+                creds.on_token_auto_refreshed(token)
+            conf = Configuration(server=DEFAULT_EWS_SERVER, auth_type=OAUTH2, credentials=creds)
+            access_type = DELEGATE
         account = Account(
             primary_smtp_address=email,
             config=conf,
             autodiscover=False,
-            access_type=DELEGATE,
+            access_type=access_type,
         )
+        account.protocol.TIMEOUT = self.ews_timeout
+
+        with self._lock:
+            # another thread might have been first
+            creds, account = self._accounts.setdefault(key, (creds, account))
+            evicted = list()
+            while len(self._accounts) > ACCOUNT_CACHE_SIZE:
+                evicted.append(self._accounts.popitem(last=False)[1])
+        for creds, old in evicted:
+            # with impersonation, every mailbox has credentials, and so a protocol, of its own
+            if self.app_only:
+                old.protocol.close()
+                try:
+                    del Protocol[old.protocol.config]
+                except KeyError:
+                    pass
         return account
 
+    def _scheduler_for(self, mailbox=None) -> EWSScheduler:
+        if not self.app_only or mailbox is None or mailbox.lower() == self.email:
+            return self.scheduler
+        mailbox = mailbox.lower()
+        with self._lock:
+            scheduler = self._schedulers.get(mailbox)
+            if scheduler is None:
+                scheduler = self._schedulers[mailbox] = EWSScheduler(
+                    rate=self.scheduler.rate,
+                    burst=self.scheduler.burst,
+                    max_retries=self.scheduler.max_retries,
+                    default_back_off=self.scheduler.default_back_off,
+                    max_interactive_wait=self.scheduler.max_interactive_wait,
+                )
+            return scheduler
+
+    def _ews(
+        self,
+        func,
+        *args,
+        priority: Priority = Priority.INTERACTIVE,
+        endpoint="calendar",
+        mailbox=None,
+        **kwargs,
+    ):
+        scheduler = self._scheduler_for(mailbox)
+        try:
+            return self.breakers[endpoint].call(scheduler.run, func, *args, priority=priority, **kwargs)
+        except exchangelib.errors.TransportError as e:
+            if type(e) is not exchangelib.errors.TransportError:
+                raise
+            raise UpstreamTransportError(str(e)) from e
+
+    def scheduler_stats(self) -> dict:
+        stats = self.scheduler.stats()
+        if self.app_only:
+            with self._lock:
+                schedulers = dict(self._schedulers)
+            stats["mailboxes"] = {mailbox: scheduler.stats() for mailbox, scheduler in schedulers.items()}
+        return stats
+
     @staticmethod
     def _parse_date(date):
-        if isinstance(date, datetime.date):
-            return date
+        # note that datetime is a subclass of date, so check that first
         if isinstance(date, datetime.datetime):
             return date.date()
+        if isinstance(date, datetime.date):
+            return date
 
         if date == "today" or date == "vandaag":
             return datetime.date.today()
@@ -263,150 +501,260 @@ class SurfAgenda:
             numdays = int(date[1:])
             return datetime.date.today() + datetime.timedelta(days=numdays)
 
-        return dateutil.parser.parse(date, dayfirst=True, yearfirst=False)
+        return dateutil.parser.parse(date, dayfirst=True, yearfirst=False).date()
 
-    def get_agenda(self, dt_start: datetime.datetime, dt_stop: datetime.datetime, email=None):
+    # Meetings that overlap with [dt_start, dt_stop], in order of start time, yielded as they are fetched: the
+    # backend pages through the range, so long ranges don't need to be held in memory at once
+    def iter_agenda(
+        self,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        email=None,
+        priority: Priority = Priority.INTERACTIVE,
+        expand_recurrence: bool | None = None,
+    ):
         self.logger.debug(
-            "get_agenda for {}, from {} to {}".format(email, dt_start, dt_stop)
+            "iter_agenda for {}, from {} to {}".format(email, dt_start, dt_stop)
         )
-        account = self._get_account(email)
 
         assert isinstance(dt_start, datetime.datetime) and isinstance(
             dt_stop, datetime.datetime
         )
         if dt_stop < dt_start:
-            return list()
-
-        def agenda_sort_key(a: exchangelib.EWSDateTime|exchangelib.EWSDate):
-            s = a.start
-            if isinstance(s, exchangelib.EWSDate) or isinstance(s, datetime.date):
-                return datetime.datetime.combine(s, datetime.time.min)
-            elif isinstance(a, exchangelib.EWSDateTime) or isinstance(s, datetime.datetime):
-                return datetime.datetime(s)
-            raise ValueError("Unknown type")
-
-        agenda_items = account.calendar.view(
-            exchangelib.EWSDateTime.from_datetime(dt_start),
-            exchangelib.EWSDateTime.from_datetime(dt_stop),
-        )
-        agenda_items = sorted(agenda_items, key=agenda_sort_key)
-
-        meetings = list()
-        for item in agenda_items:
-            # print("===========================")
-            # print(item)
-
-            is_private = item.sensitivity.lower() == "private"
+            return
 
-            attendees = list()
-            if not is_private:
-                # note that optional_attendees and required_attendees might be None
-                attendees = set(
-                    Attendee.from_ews(p) for p in (item.optional_attendees or []) + (item.required_attendees or [])
-                )
-
-            resources = list()
-            if not is_private:
-                # note that optional_attendees and required_attendees might be None
-                resources = set(Attendee.from_ews(p) for p in (item.resources or []))
-
-            organizer = Attendee()
-            if item.organizer and not is_private:
-                organizer = Attendee(item.organizer.name, item.organizer.email_address, ResponseType.ORGANIZER)
-
-                # this corrects the responsetype;
-                # works because Attendee equality only considers email addresses
-                if organizer in attendees:
-                    attendees.remove(organizer)
-                attendees.add(organizer)
-
-            def ewstime2datetime(t: exchangelib.EWSDate|exchangelib.EWSDateTime, tz: datetime.tzinfo = None):
-                # note that EWSDate is a subclass of datetime.date, and EWSDateTime is a subclass of datetime
-                if isinstance(t, datetime.date):
-                    return datetime.datetime.combine(item.start, datetime.time.min, tzinfo=tz)
-                elif isinstance(t, datetime.datetime):
-                    return datetime.datetime(t).astimezone(tz)
-                raise ValueError("Unknown type")
-
-            start = ewstime2datetime(item.start, self.tz)
-            end = ewstime2datetime(item.end, self.tz)
-
-            # TODO: handle stringification during json serialization
-            meeting = dict(
-                {
-                    "start": start,
-                    "end": end,
-                    "time_start": start.strftime("%H:%M"),
-                    "time_end": end.strftime("%H:%M"),
-                    "date_start": start.strftime("%Y-%m-%d"),
-                    "date_end": end.strftime("%Y-%m-%d"),
-                    "duration": end-start,
-                    "all_day": item.is_all_day,
-                    "organizer": organizer,
-                    "online": item.is_online_meeting,
-                    "subject": (item.subject if not is_private else "Private appointment"),
-                    "description": (item.text_body if not is_private else ""),
-                    "location": item.location if not is_private else "Undisclosed",
-                    "attendees": attendees,
-                    "resources": resources,
-                    "my_response": ResponseType(item.my_response_type),
-                }
-            )
-            meetings.append(meeting)
-            self.logger.debug("  - {start}-{end}: {subject}".format(**meeting))
-
-        # this probably is already sorted, but let's just make sure
-        meetings = sorted(meetings, key=lambda a: a["start"])
+        if expand_recurrence is None:
+            expand_recurrence = self.expand_recurrence
+        yield from self.backend.iter_agenda(
+            email or self.email, dt_start, dt_stop, priority=priority, expand_recurrence=expand_recurrence
+        )
 
-        return meetings
+    def get_agenda(
+        self,
+        dt_start: datetime.datetime,
+        dt_stop: datetime.datetime,
+        email=None,
+        priority: Priority = Priority.INTERACTIVE,
+        expand_recurrence: bool | None = None,
+    ):
+        return list(self.iter_agenda(dt_start, dt_stop, email, priority=priority, expand_recurrence=expand_recurrence))
 
-    def get_agenda_for_days(self, date_start: datetime.date, date_stop: datetime.date, email=None):
+    def get_agenda_for_days(
+        self,
+        date_start: datetime.date,
+        date_stop: datetime.date,
+        email=None,
+        priority: Priority = Priority.INTERACTIVE,
+    ):
         assert isinstance(date_start, datetime.date) and isinstance(
             date_stop, datetime.date
         )
 
-        dt_start = datetime.datetime.combine(
-            date_start, datetime.time(hour=0, minute=0, second=0, tzinfo=self.tz)
-        )
-        dt_stop = datetime.datetime.combine(
-            date_stop, datetime.time(hour=23, minute=59, second=59, tzinfo=self.tz)
-        )
+        dt_start, dt_stop = self._day_range(date_start, date_stop)
+        return self.get_agenda(email=email, dt_start=dt_start, dt_stop=dt_stop, priority=priority)
 
-        return self.get_agenda(email=email, dt_start=dt_start, dt_stop=dt_stop)
+    def _day_range(self, date_start: datetime.date, date_stop: datetime.date):
+        # pytz zones need localize(); passing them as tzinfo gives their LMT offset
+        dt_start = self.tz.localize(datetime.datetime.combine(date_start, datetime.time(hour=0, minute=0, second=0)))
+        dt_stop = self.tz.localize(datetime.datetime.combine(date_stop, datetime.time(hour=23, minute=59, second=59)))
+        return dt_start, dt_stop
 
-    def get_agenda_for_day(self, email=None, date=datetime.date.today()):
+    def get_agenda_for_day(self, email=None, date=datetime.date.today(), priority: Priority = Priority.INTERACTIVE):
         realdate = self._parse_date(date)
         assert isinstance(realdate, datetime.date)
-        return self.get_agenda_for_days(email=email, date_start=realdate, date_stop=realdate), realdate
+        return self._get_agenda_entry(email, realdate, priority)["data"], realdate
+
+    # The agenda of a day together with its digest, version and stale flag, all from a single cache lookup; separate
+    # lookups could each see a different version of the entry when it is refreshed in between.
+    def get_agenda_entry(self, email=None, date=datetime.date.today(), priority: Priority = Priority.INTERACTIVE):
+        realdate = self._parse_date(date)
+        entry = self._get_agenda_entry(email, realdate, priority)
+        return {
+            "data": entry["data"],
+            "date": realdate,
+            "digest": entry["digest"],
+            "version": entry["version"],
+            "stale": bool(entry.get("stale")),
+        }
+
+    def agenda_digest(self, email=None, date=datetime.date.today()) -> str:
+        return self._get_agenda_entry(email, self._parse_date(date))["digest"]
+
+    def _get_agenda_entry(self, email, date: datetime.date, priority: Priority = Priority.INTERACTIVE) -> dict:
+        key = (email or self.email, date)
+        with self._lock:
+            entry = self._agendas.get(key)
+        if entry is not None:
+            if time.time() - entry["updated"] <= self.agenda_ttl:
+                return entry
+            if entry.get("stale"):
+                self._refresh_in_background(("agenda",) + key, self._refresh_agenda_entry, email, date)
+                return entry
+
+        try:
+            return self._refresh_agenda_entry(email, date, priority=priority)
+        except Exception as e:
+            if entry is None or not is_upstream_failure(e):
+                raise
+            # serve the last known agenda; from now on it is refreshed in the background
+            self.logger.warning("Serving stale agenda for %s on %s: %s", key[0], date, e)
+            entry["stale"] = True
+            return entry
+
+    # Every (mailbox, day) has a version and a short log of what changed between versions, so clients can ask for
+    # just the changes since the version they have. Versions come from a single counter that starts at the current
+    # time, so they keep increasing when entries are evicted or the process restarts. Every WSGI process has a
+    # counter of its own, so versions also end in a random tag per process, and changes are only computed for
+    # versions this process issued itself.
+    def _next_version(self) -> int:
+        return next(self._versions) * VERSION_TAGS + self._version_tag
+
+    def _add_version(self, entry: dict, previous: dict | None):
+        # needs to be called with the lock held
+        if previous is not None and previous["digest"] == entry["digest"]:
+            entry.update(version=previous["version"], log=previous["log"])
+            return
+        version = self._next_version()
+        if previous is None:
+            entry.update(version=version, log=list())
+            return
+
+        old = {meeting["id"]: meeting_fingerprint(meeting) for meeting in previous["data"]}
+        new = {meeting["id"]: meeting_fingerprint(meeting) for meeting in entry["data"]}
+        change = {
+            "since": previous["version"],
+            "version": version,
+            "added": [i for i in new if i not in old],
+            "changed": [i for i in new if i in old and new[i] != old[i]],
+            "removed": [i for i in old if i not in new],
+        }
+        log = (previous["log"] + [change])[-self.change_log_size :] if self.change_log_size > 0 else list()
+        entry.update(version=version, log=log)
+
+    # The changes to an agenda since version `since`, or the full agenda if they can't be computed from the log
+    def get_agenda_delta(
+        self,
+        email=None,
+        date=datetime.date.today(),
+        since: int | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> dict:
+        realdate = self._parse_date(date)
+        entry = self._get_agenda_entry(email, realdate, priority)
+        with self._lock:
+            version, log, data = entry["version"], list(entry["log"]), entry["data"]
+
+        # only versions in the log are known; anything else might even have been issued by another process
+        known = {version} | {change["since"] for change in log}
+        result = {"date": realdate, "version": version, "stale": bool(entry.get("stale"))}
+        if since is None or since not in known:
+            return dict(result, full=True, agenda=data)
+
+        # net effect of all changes after `since`
+        state = dict()
+        for change in log:
+            if change["version"] <= since:
+                continue
+            for i in change["added"]:
+                state[i] = "changed" if state.get(i) == "removed" else "added"
+            for i in change["changed"]:
+                state[i] = state.get(i, "changed")
+            for i in change["removed"]:
+                if state.get(i) == "added":
+                    del state[i]
+                else:
+                    state[i] = "removed"
+
+        return dict(
+            result,
+            full=False,
+            since=since,
+            added=[meeting for meeting in data if state.get(meeting["id"]) == "added"],
+            changed=[meeting for meeting in data if state.get(meeting["id"]) == "changed"],
+            removed=sorted(i for i, what in state.items() if what == "removed"),
+        )
+
+    def agenda_version(self, email=None, date=datetime.date.today()) -> int:
+        return self._get_agenda_entry(email, self._parse_date(date))["version"]
+
+    def is_agenda_stale(self, email=None, date=datetime.date.today()) -> bool:
+        with self._lock:
+            entry = self._agendas.get((email or self.email, self._parse_date(date)))
+        return entry is not None and bool(entry.get("stale"))
+
+    def cache_sizes(self) -> dict:
+        with self._lock:
+            return {
+                "agendas": len(self._agendas),
+                "stale_agendas": sum(1 for entry in self._agendas.values() if entry.get("stale")),
+                "status": len(self._status),
+                "recurring_masters": self.backend.stats().get("recurring_masters", 0),
+                "rooms": len(self._rooms["data"] or ()),
+                "refreshing": len(self._refreshing),
+                "people": len(self.people._people),
+            }
+
+    def _refresh_agenda_entry(self, email, date: datetime.date, priority: Priority = Priority.INTERACTIVE) -> dict:
+        data = self.get_agenda_for_days(email=email, date_start=date, date_stop=date, priority=priority)
+        return self._store_agenda_entry(email, date, data)
+
+    def _store_agenda_entry(self, email, date: datetime.date, data: list) -> dict:
+        key = (email or self.email, date)
+        entry = {"updated": time.time(), "digest": data_digest(data), "data": data}
+        with self._lock:
+            previous = self._agendas.get(key)
+            self._add_version(entry, previous)
+            self._agendas[key] = entry
+            self._agendas.move_to_end(key)
+            while len(self._agendas) > self.agenda_cache_size:
+                self._agendas.popitem(last=False)
+
+        self.people.learn(attendee for meeting in data for attendee in meeting["attendees"])
+
+        # only record room agendas that actually changed, so the history doesn't grow with every refresh
+        if self.utilisation is not None and self._is_room(key[0]):
+            if previous is None or previous["digest"] != entry["digest"]:
+                self.utilisation.record(key[0], self._parse_date(date), self._parse_date(date), data)
+        return entry
 
     def get_availability(self, email, date=datetime.date.today()):
         self.logger.info("Fetching availability for %s on %s", email, date.isoformat())
 
-        agenda, realdate = self.get_agenda_for_day(email, date)
+        try:
+            entry = self.get_agenda_entry(email, date)
+        except Exception as e:
+            with self._lock:
+                last = self._status.get(email)
+            if last is None or last["date"] != self._parse_date(date) or not is_upstream_failure(e):
+                raise
+            self.logger.warning("Serving stale status for %s: %s", email, e)
+            return dict(last["data"], stale=True)
+        agenda, realdate, stale = entry["data"], entry["date"], entry["stale"]
         now = datetime.datetime.now(tz=self.tz)
 
         self.logger.info("Now is %s", now.isoformat())
-        self.logger.debug(
-            "Agenda for %s: %s",
-            email,
-            json.dumps(agenda, sort_keys=True, indent=4, cls=JSONAgendaEncoder),
-        )
+        # the whole agenda is only serialized when it is actually logged
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "Agenda for %s: %s",
+                email,
+                json.dumps(agenda, sort_keys=True, indent=4, cls=JSONAgendaEncoder),
+            )
         # debugging
         # now = now.replace(hour=10,minute=15)
 
-        # walk through list to find current/next meeting
-        index_next, entry_next = findfirst(agenda, lambda a: a["end"] > now)
-        self.logger.debug(
-            "Next is {}: {}".format(
-                index_next, json.dumps(entry_next, cls=JSONAgendaEncoder)
-            )
-        )
+        # walk through the agenda (sorted by start time) once: find the current/next meeting, and from there on,
+        # the first gap; the rest of the agenda isn't looked at
+        meetings = iter(agenda)
+        entry_next = next((a for a in meetings if a["end"] > now), None)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Next is {}".format(json.dumps(entry_next, cls=JSONAgendaEncoder)))
 
         # three possibilities now:
         # (1) no further meetings today (nothing found, None returned)
         # (2) room is currently free (so next meeting hasn't started)
         # (3) room is currently occupied (next meeting has started)
-        if index_next is None:
+        if entry_next is None:
             self.logger.debug("fork (1)")
             available = True
             next_dt = None
@@ -425,50 +773,298 @@ class SurfAgenda:
             # find next available slot by checking for a gap between meeting of at least 5 minutes
             # keep track of latest endtime of all relevant meetings
             last = entry_next["end"]
-            for i, a in enumerate(agenda[index_next:-2], index_next):
-                if agenda[i + 1]["start"] - last > datetime.timedelta(minutes=5):
-                    next_dt = last
+            for a in meetings:
+                if a["start"] - last > datetime.timedelta(minutes=5):
                     break
-                if agenda[i + 1]["end"] > last:
-                    last = agenda[i + 1]["end"]
-            else:
-                # last element determines end time
-                next_dt = last
+                if a["end"] > last:
+                    last = a["end"]
+            # either the start of the gap, or the end of the last meeting
+            next_dt = last
             if next_dt.date() == now.date():
                 txt = "bezet tot {}".format(next_dt.strftime("%H:%M"))
             else:
                 txt = "bezet"
 
         status = {"available": available, "next": next_dt, "status": txt}
+        if stale:
+            status["stale"] = True
         self.logger.debug(
             "Returning {}".format(json.dumps(status, cls=JSONAgendaEncoder))
         )
+        with self._lock:
+            self._status[email] = {"updated": time.time(), "date": realdate, "data": status}
         return status
 
-    def get_rooms_agendas(self):
+    def get_rooms_agendas(self, priority: Priority = Priority.BACKGROUND):
         all = dict()
-        for room in self.get_rooms().values():
-            all[room["number"]] = self.get_agenda_for_day(room["email"])
+        for room, agenda, error in self.iter_rooms_agendas(workers=1, priority=priority):
+            if error is not None:
+                raise error
+            all[room["number"]] = agenda
         return all
 
-    def get_rooms(self):
-        if (
-            time.time() - self._rooms["updated"] > 24 * 3600
-            or self._rooms["data"] is None
-        ):
-            self.logger.debug(
-                "fetching rooms, age=%f" % (time.time() - self._rooms["updated"])
-            )
-            self._rooms["data"] = self._fetch_rooms()
-            self._rooms["updated"] = time.time()
+    # Agendas of all rooms for a single day, as (room, (agenda, date), error), as soon as each room is done.
+    # With a backend that can batch requests, rooms are fetched in batches of that size.
+    # The date is parsed and the room list fetched right away, so those errors are raised by the call itself rather
+    # than when iterating.
+    def iter_rooms_agendas(self, date="today", workers: int = 4, priority: Priority = Priority.BACKGROUND):
+        realdate = self._parse_date(date)
+        rooms = self.get_rooms(priority=priority).query()
+        return self._iter_rooms_agendas(rooms, realdate, workers, priority)
+
+    def _iter_rooms_agendas(self, rooms: list, realdate: datetime.date, workers: int, priority: Priority):
+        def fetch(chunk):
+            self._prefetch_agendas([room["email"] for room in chunk], realdate, priority=priority)
+            results = list()
+            for room in chunk:
+                try:
+                    results.append((room, self.get_agenda_for_day(room["email"], realdate, priority=priority), None))
+                except Exception as e:
+                    results.append((room, None, e))
+            return results
+
+        chunks = self._chunks(rooms, self.backend.batch_size)
+        for chunk, results, error in self._map_concurrently(fetch, chunks, workers):
+            if error is not None:
+                results = [(room, None, error) for room in chunk]
+            for room, agenda, error in results:
+                if error is not None:
+                    self.logger.warning("Could not fetch agenda for room %s: %s", room["number"], error)
+                yield room, agenda, error
+
+    # Fill the agenda cache for several mailboxes with a single batched backend request. Mailboxes that fail are
+    # left alone, and will be fetched (or served stale) one by one.
+    def _prefetch_agendas(self, emails: list, date: datetime.date, priority: Priority = Priority.BACKGROUND):
+        now = time.time()
+        with self._lock:
+            missing = list()
+            for email in emails:
+                entry = self._agendas.get((email, date))
+                if entry is None or now - entry["updated"] > self.agenda_ttl:
+                    missing.append(email)
+        if len(missing) < 2:
+            return
+
+        dt_start, dt_stop = self._day_range(date, date)
+        try:
+            agendas = self.backend.get_agendas(missing, dt_start, dt_stop, priority=priority)
+        except Exception as e:
+            if not is_upstream_failure(e):
+                raise
+            self.logger.warning("Could not prefetch agendas: %s", e)
+            return
+        for email, data in agendas.items():
+            if not isinstance(data, Exception):
+                self._store_agenda_entry(email, date, data)
+
+    # Fetch the agendas of many mailboxes concurrently, and yield (email, agenda, error) as soon as each mailbox is
+    # done. At most `workers` requests are in flight, so memory use doesn't depend on the number of mailboxes; with
+    # a backend that can batch requests, every request covers a batch of mailboxes.
+    def iter_agendas(
+        self,
+        emails,
+        date_start: datetime.date,
+        date_stop: datetime.date,
+        workers: int = 4,
+        priority: Priority = Priority.BACKGROUND,
+    ):
+        dt_start, dt_stop = self._day_range(date_start, date_stop)
+
+        def fetch(chunk):
+            if len(chunk) == 1:
+                return {chunk[0]: self.get_agenda(dt_start, dt_stop, email=chunk[0], priority=priority)}
+            return self.backend.get_agendas(chunk, dt_start, dt_stop, priority=priority)
+
+        chunks = self._chunks(emails, self.backend.batch_size)
+        for chunk, agendas, error in self._map_concurrently(fetch, chunks, workers):
+            for email in chunk:
+                agenda = error if error is not None else agendas[email]
+                if isinstance(agenda, Exception):
+                    self.logger.warning("Could not fetch agenda for %s: %s", email, agenda)
+                    yield email, None, agenda
+                else:
+                    yield email, agenda, None
+
+    @staticmethod
+    def _chunks(items, size: int):
+        items = iter(items)
+        while chunk := list(itertools.islice(items, size)):
+            yield chunk
 
-        return self._rooms["data"]
+    # Run func for every item, with at most `workers` in flight, and yield (item, result, error) in order of
+    # completion. Items are only taken from the iterable when there is room for them.
+    @staticmethod
+    def _map_concurrently(func, items, workers: int):
+        items = iter(items)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        def submit(n):
+            for item in itertools.islice(items, n):
+                pending[pool.submit(func, item)] = item
 
-    def _fetch_rooms(self):
+        pending = dict()
+        try:
+            submit(workers)
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    submit(1)
+                    try:
+                        result, error = future.result(), None
+                    except Exception as e:
+                        result, error = None, e
+                    yield item, result, error
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def get_rooms(self, priority: Priority = Priority.INTERACTIVE):
+        return self._get_rooms_entry(priority)["data"]
+
+    # The room list together with its digest and stale flag, from a single lookup, like get_agenda_entry()
+    def get_rooms_entry(self, priority: Priority = Priority.INTERACTIVE):
+        entry = self._get_rooms_entry(priority)
+        return {"data": entry["data"], "digest": entry["digest"], "stale": bool(entry.get("stale"))}
+
+    def _get_rooms_entry(self, priority: Priority = Priority.INTERACTIVE) -> dict:
+        rooms = self._rooms
+        if rooms.get("stale") and rooms["data"] is not None:
+            # e.g., loaded from a snapshot, or kept during an outage: serve it, but refresh it right away
+            self._refresh_in_background(("rooms",), self._refresh_rooms)
+        elif time.time() - rooms["updated"] > 24 * 3600 or rooms["data"] is None:
+            try:
+                rooms = self._refresh_rooms(priority=priority)
+            except Exception as e:
+                if rooms["data"] is None or not is_upstream_failure(e):
+                    raise
+                self.logger.warning("Serving stale room list: %s", e)
+                rooms["stale"] = True
+
+        return rooms
+
+    def is_rooms_stale(self) -> bool:
+        return bool(self._rooms.get("stale"))
+
+    def _refresh_rooms(self, priority: Priority = Priority.INTERACTIVE) -> dict:
+        self.logger.debug(
+            "fetching rooms, age=%f" % (time.time() - self._rooms["updated"])
+        )
+        data = RoomDirectory(self._fetch_rooms(priority=priority))
+        # replace the entry as a whole, so other threads never see a half-updated one
+        self._rooms = {"updated": time.time(), "data": data, "digest": data_digest(data)}
+        return self._rooms
+
+    def _is_room(self, email) -> bool:
+        rooms = self._rooms["data"]
+        return rooms is not None and rooms.by_email(email) is not None
+
+    def get_utilisation(self, date_start, date_stop, by="room") -> dict:
+        if self.utilisation is None:
+            raise ValueError("Utilisation statistics are not enabled")
+        if by not in ("room", "floor", "location", "type"):
+            raise ValueError("Can't group utilisation by {}".format(by))
+        date_start, date_stop = self._parse_date(date_start), self._parse_date(date_stop)
+        rooms = self.get_rooms()
+        return {
+            "start": date_start,
+            "stop": date_stop,
+            "by": by,
+            "utilisation": self.utilisation.utilisation(date_start, date_stop, by=by, rooms=rooms),
+            "no_shows": self.utilisation.no_shows(date_start, date_stop, by=by, rooms=rooms),
+        }
+
+    def rooms_digest(self) -> str:
+        return self._get_rooms_entry()["digest"]
+
+    def _refresh_in_background(self, key, func, *args):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                func(*args, priority=Priority.BACKGROUND)
+            except Exception:
+                self.logger.exception("Background refresh of %s failed", key)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name="surfagenda-refresh", daemon=True).start()
+
+    def save_snapshot(self, path=None):
+        path = Path(path) if path is not None else self.snapshot_file
+        if path is None:
+            return
+
+        # only keep agendas that are still relevant
+        today = datetime.date.today()
+        with self._lock:
+            rooms = self._rooms
+            agendas = [(key, entry) for key, entry in self._agendas.items() if key[1] >= today]
+            status = dict(self._status)
+
+        meta = {"rooms": None, "agendas": list(), "status": status}
+        with SnapshotWriter(path) as snapshot:
+            if rooms["data"] is not None:
+                snapshot.add("rooms", rooms["data"])
+                meta["rooms"] = {"updated": rooms["updated"], "digest": rooms["digest"]}
+            for n, (key, entry) in enumerate(agendas):
+                blob = "agenda/{}".format(n)
+                snapshot.add(blob, entry["data"])
+                meta["agendas"].append((key, blob, entry["updated"], entry["digest"]))
+            snapshot.add("meta", meta)
+
+        self.logger.info("Saved snapshot with %d agendas to %s", len(agendas), path)
+
+    def load_snapshot(self, path):
+        try:
+            snapshot = Snapshot(path)
+            meta = snapshot.get("meta")
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, zlib.error) as e:
+            self.logger.warning("Could not load snapshot %s: %s", path, e)
+            return
+
+        with self._lock:
+            if meta["rooms"] is not None and self._rooms["data"] is None:
+                self._rooms = LazyEntry(snapshot, "rooms", stale=True, **meta["rooms"])
+            for key, blob, updated, digest in meta["agendas"]:
+                if key not in self._agendas:
+                    version = self._next_version()
+                    self._agendas[key] = LazyEntry(
+                        snapshot,
+                        blob,
+                        updated=updated,
+                        digest=digest,
+                        stale=True,
+                        version=version,
+                        log=list(),
+                    )
+            for email, entry in meta["status"].items():
+                self._status.setdefault(email, dict(entry, stale=True))
+
+        self.logger.info("Loaded snapshot with %d agendas from %s", len(meta["agendas"]), path)
+
+    def _snapshot_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save_snapshot()
+            except Exception:
+                self.logger.exception("Could not save snapshot")
+
+    def _fetch_rooms(self, priority: Priority = Priority.INTERACTIVE):
         account = self._get_account(self.email)
         all_rooms = dict()
-        for roomlist in account.protocol.get_roomlists():
-            for room in account.protocol.get_rooms(roomlist.email_address):
+        roomlists = self._ews(lambda: list(account.protocol.get_roomlists()), priority=priority, endpoint="directory")
+        for roomlist in roomlists:
+            rooms = self._ews(
+                lambda: list(account.protocol.get_rooms(roomlist.email_address)),
+                priority=priority,
+                endpoint="directory",
+            )
+            for room in rooms:
                 # parse room name for useful info
                 # vergaderzaal 4.1 (18p, 75” lcd, conf. telefoon)
                 match = re.search("^(\S+) +(\d.\d+) +\((\d+)p", room.name)
@@ -499,6 +1095,7 @@ class SurfAgenda:
                         "email": room.email_address.lower(),
                         "type": room_type,
                         "people": room_pers,
+                        "capacity": int(room_pers) if room_pers.isdigit() else None,
                         "number": room_num,
                         "floor": room_floor,
                         "floor_subnum": room_floornum,
@@ -511,14 +1108,6 @@ class SurfAgenda:
 
 
 if __name__ == "__main__":
-    import configparser
-
-    config = configparser.ConfigParser()
-    config.read("webapp.config")
-    config = config._sections["config"]
+    from .cli import main
 
-    surfagenda = SurfAgenda(**config)
-    # items_today = surfagenda.get_agenda('otheruser@example.org',datetime.date(year=2017,month=4,day=10),datetime.date(year=2017,month=4,day=14))
-    print(
-        json.dumps(items_today, sort_keys=True, indent=4, cls=JSONAgendaEncoder)
-    )  # pprint(items_today)
+    sys.exit(main())
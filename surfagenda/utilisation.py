@@ -0,0 +1,365 @@
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .surfagenda import ResponseType
+
+# Append-only store of room bookings, kept as NumPy columns, for utilisation statistics.
+#
+# Bookings are recorded from the room agendas we fetch anyway. Every time a room's agenda is recorded for a range of
+# days, those days are marked as covered by that batch; for every (room, day) only the bookings of the most recent
+# batch count. That way, bookings that were moved or cancelled disappear from the statistics without ever having
+# to modify stored data.
+#
+# All times are stored as local wall-clock seconds since the epoch, so days and hours of the week can be computed
+# with plain integer arithmetic.
+
+DAY = 24 * 3600
+HOUR = 3600
+HOURS_PER_WEEK = 7 * 24
+# 1970-01-01 was a Thursday; this turns epoch days into weekdays with Monday = 0
+EPOCH_WEEKDAY = 3
+# used to make times of different rooms sortable in a single array
+ROOM_OFFSET = 1 << 40
+
+DEFAULT_FLUSH_INTERVAL = 300  # seconds
+DEFAULT_MAX_SEGMENTS = 50
+
+BOOKING_COLUMNS = {
+    "room": np.int32,
+    "batch": np.int64,
+    "day": np.int32,
+    "start": np.int64,
+    "end": np.int64,
+    "invitees": np.int16,
+    "accepted": np.int16,
+    "declined": np.int16,
+    # the room itself declined the booking
+    "room_declined": np.bool_,
+}
+COVERAGE_COLUMNS = {
+    "room": np.int32,
+    "batch": np.int64,
+    "day": np.int32,
+}
+
+
+def _local_seconds(dt: datetime.datetime) -> int:
+    naive = dt.replace(tzinfo=None)
+    return (naive - datetime.datetime(1970, 1, 1)) // datetime.timedelta(seconds=1)
+
+
+def _epoch_day(date: datetime.date) -> int:
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+def _empty(columns: dict) -> dict:
+    return {name: np.empty(0, dtype=dtype) for name, dtype in columns.items()}
+
+
+def _concatenate(chunks: list[dict], columns: dict) -> dict:
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in columns}
+
+
+class UtilisationStore:
+    def __init__(
+        self,
+        directory: Path | str | None = None,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        max_segments=DEFAULT_MAX_SEGMENTS,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.directory = Path(directory) if directory is not None else None
+        self.flush_interval = float(flush_interval)
+        self.max_segments = int(max_segments)
+
+        self._lock = threading.Lock()
+        self._rooms = list()  # room index -> email
+        self._room_index = dict()  # email -> room index
+        self._bookings = _empty(BOOKING_COLUMNS)
+        self._coverage = _empty(COVERAGE_COLUMNS)
+        self._segments = 0  # number of segment files
+        self._next_segment = 0  # index of the next segment file
+        self._batch = 0
+
+        # recorded chunks that have not been merged into the columns (or written to disk) yet
+        self._pending = list()
+        self._flushed = time.time()
+
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._load()
+
+    def _load(self):
+        rooms_file = self.directory / "rooms.json"
+        if rooms_file.exists():
+            self._rooms = json.loads(rooms_file.read_text())
+            self._room_index = {email: i for i, email in enumerate(self._rooms)}
+
+        bookings, coverage = [self._bookings], [self._coverage]
+        for segment in sorted(self.directory.glob("segment-*.npz")):
+            with np.load(segment) as data:
+                chunk = {name: data["booking_" + name] for name in BOOKING_COLUMNS if "booking_" + name in data.files}
+                if "room_declined" not in chunk:
+                    # older segments marked bookings the room declined with more declines than invitees
+                    chunk["room_declined"] = chunk["declined"] > chunk["invitees"]
+                    chunk["declined"] = np.minimum(chunk["declined"], chunk["invitees"])
+                bookings.append(chunk)
+                coverage.append({name: data["coverage_" + name] for name in COVERAGE_COLUMNS})
+            self._segments += 1
+            # segment indexes have gaps after compaction, so continue after the highest one
+            self._next_segment = max(self._next_segment, int(segment.stem.split("-")[1]) + 1)
+        self._bookings = _concatenate(bookings, BOOKING_COLUMNS)
+        self._coverage = _concatenate(coverage, COVERAGE_COLUMNS)
+        if len(self._coverage["batch"]):
+            self._batch = int(self._coverage["batch"].max()) + 1
+
+        self.logger.info(
+            "Loaded %d bookings for %d rooms from %s", len(self._bookings["room"]), len(self._rooms), self.directory
+        )
+
+    def _save_segment(self, bookings: dict, coverage: dict) -> Path:
+        segment = self.directory / "segment-{:06d}.npz".format(self._next_segment)
+        tmp = segment.with_name(segment.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                **{"booking_" + name: values for name, values in bookings.items()},
+                **{"coverage_" + name: values for name, values in coverage.items()},
+            )
+        (self.directory / "rooms.json").write_text(json.dumps(self._rooms))
+        tmp.replace(segment)
+        self._segments += 1
+        self._next_segment += 1
+        return segment
+
+    def record(self, email: str, date_start: datetime.date, date_stop: datetime.date, meetings: list[dict]):
+        window_start = _epoch_day(date_start) * DAY
+        window_stop = (_epoch_day(date_stop) + 1) * DAY
+
+        rows = {name: list() for name in BOOKING_COLUMNS}
+        for meeting in meetings:
+            start = max(_local_seconds(meeting["start"]), window_start)
+            end = min(_local_seconds(meeting["end"]), window_stop)
+            if end <= start:
+                continue
+
+            # the organizer and the rooms themselves don't count as invitees
+            rooms = {email.lower()} | {r.email.lower() for r in meeting["resources"] if r.email}
+            invitees = [
+                a for a in meeting["attendees"] if a != meeting["organizer"] and (a.email or "").lower() not in rooms
+            ]
+            accepted = sum(a.response in (ResponseType.ACCEPT, ResponseType.TENTATIVE) for a in invitees)
+            declined = sum(a.response == ResponseType.DECLINE for a in invitees)
+
+            rows["start"].append(start)
+            rows["end"].append(end)
+            rows["day"].append(start // DAY)
+            rows["invitees"].append(len(invitees))
+            rows["accepted"].append(accepted)
+            rows["declined"].append(declined)
+            rows["room_declined"].append(meeting["my_response"] == ResponseType.DECLINE)
+
+        with self._lock:
+            if email not in self._room_index:
+                self._room_index[email] = len(self._rooms)
+                self._rooms.append(email)
+            room = self._room_index[email]
+            batch = self._batch
+            self._batch += 1
+
+            rows["room"] = [room] * len(rows["start"])
+            rows["batch"] = [batch] * len(rows["start"])
+            bookings = {name: np.array(rows[name], dtype=dtype) for name, dtype in BOOKING_COLUMNS.items()}
+            days = np.arange(window_start // DAY, window_stop // DAY, dtype=np.int32)
+            coverage = {
+                "room": np.full(len(days), room, dtype=np.int32),
+                "batch": np.full(len(days), batch, dtype=np.int64),
+                "day": days,
+            }
+
+            self._pending.append((bookings, coverage))
+
+        if time.time() - self._flushed > self.flush_interval:
+            self.flush()
+
+    def _merge_pending(self):
+        # needs to be called with the lock held; returns the merged chunks
+        pending, self._pending = self._pending, list()
+        if pending:
+            bookings = _concatenate([b for b, _ in pending], BOOKING_COLUMNS)
+            coverage = _concatenate([c for _, c in pending], COVERAGE_COLUMNS)
+            self._bookings = _concatenate([self._bookings, bookings], BOOKING_COLUMNS)
+            self._coverage = _concatenate([self._coverage, coverage], COVERAGE_COLUMNS)
+            return bookings, coverage
+        return None
+
+    def flush(self):
+        with self._lock:
+            merged = self._merge_pending()
+            self._flushed = time.time()
+            if merged is not None and self.directory is not None:
+                self._save_segment(*merged)
+            compact = self.directory is not None and self._segments > self.max_segments
+        if compact:
+            self.compact()
+
+    # compact all segments into one, dropping bookings that have been superseded
+    def compact(self):
+        with self._lock:
+            self._merge_pending()
+            current = self._current(self._bookings, self._coverage)
+            self._bookings = {name: values[current] for name, values in self._bookings.items()}
+            latest = self._latest_coverage(self._coverage)
+            self._coverage = {name: values[latest] for name, values in self._coverage.items()}
+            if self.directory is not None:
+                old = sorted(self.directory.glob("segment-*.npz"))
+                written = self._save_segment(self._bookings, self._coverage)
+                for segment in old:
+                    if segment != written:
+                        segment.unlink()
+                self._segments = 1
+
+    @staticmethod
+    def _latest_coverage(coverage: dict) -> np.ndarray:
+        # index of the latest batch for every (room, day)
+        order = np.lexsort((coverage["batch"], coverage["day"], coverage["room"]))
+        room, day = coverage["room"][order], coverage["day"][order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (room[1:] != room[:-1]) | (day[1:] != day[:-1])
+        return order[last]
+
+    def _current(self, bookings: dict, coverage: dict) -> np.ndarray:
+        # boolean mask of the bookings that belong to the latest batch of their (room, day)
+        latest = self._latest_coverage(coverage)
+        if not len(latest):
+            return np.zeros(len(bookings["room"]), dtype=bool)
+        keys = coverage["room"][latest].astype(np.int64) << 32 | coverage["day"][latest].astype(np.int64)
+        batches = coverage["batch"][latest]
+        order = np.argsort(keys)
+        keys, batches = keys[order], batches[order]
+
+        booking_keys = bookings["room"].astype(np.int64) << 32 | bookings["day"].astype(np.int64)
+        pos = np.minimum(np.searchsorted(keys, booking_keys), len(keys) - 1)
+        return (keys[pos] == booking_keys) & (batches[pos] == bookings["batch"])
+
+    def _select(self, date_start: datetime.date, date_stop: datetime.date) -> tuple[dict, dict]:
+        # returns the current bookings, and the covered (room, day) pairs, of the period
+        with self._lock:
+            self._merge_pending()
+            bookings, coverage = self._bookings, self._coverage
+        first, last = _epoch_day(date_start), _epoch_day(date_stop)
+        mask = self._current(bookings, coverage)
+        mask &= (bookings["day"] >= first) & (bookings["day"] <= last)
+        latest = self._latest_coverage(coverage)
+        covered = latest[(coverage["day"][latest] >= first) & (coverage["day"][latest] <= last)]
+        return (
+            {name: values[mask] for name, values in bookings.items()},
+            {name: values[covered] for name, values in coverage.items()},
+        )
+
+    def _group_rooms(self, by: str, rooms: dict | None) -> tuple[list, np.ndarray]:
+        # returns the group labels, and the group index for every room index
+        info = dict()
+        for room in (rooms or dict()).values():
+            info[room["email"]] = room
+        labels = list()
+        for email in self._rooms:
+            room = info.get(email)
+            if by == "room":
+                labels.append(room["number"] if room else email)
+            else:
+                labels.append(str(room[by]) if room else "unknown")
+        groups, index = np.unique(np.array(labels, dtype=object).astype(str), return_inverse=True)
+        return [str(group) for group in groups], index.astype(np.int64)
+
+    @staticmethod
+    def _merge(room: np.ndarray, start: np.ndarray, end: np.ndarray):
+        # merge overlapping bookings of the same room, so double bookings aren't counted twice
+        if not len(room):
+            return room, start, end
+        order = np.lexsort((start, room))
+        room, start, end = room[order].astype(np.int64), start[order], end[order]
+        offset = room * ROOM_OFFSET
+        running_end = np.maximum.accumulate(end + offset) - offset
+        new = np.ones(len(room), dtype=bool)
+        new[1:] = (room[1:] != room[:-1]) | (start[1:] > running_end[:-1])
+        first = np.flatnonzero(new)
+        return room[first], start[first], np.maximum.reduceat(end, first)
+
+    @staticmethod
+    def _hours_of_week(start: np.ndarray, end: np.ndarray):
+        # split intervals at hour boundaries; returns (interval index, hour of week, seconds)
+        first = start // HOUR
+        last = (end - 1) // HOUR
+        count = last - first + 1
+        interval = np.repeat(np.arange(len(start)), count)
+        hour = np.repeat(first, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        seconds = np.minimum(end[interval], (hour + 1) * HOUR) - np.maximum(start[interval], hour * HOUR)
+        hour_of_week = ((hour // 24 + EPOCH_WEEKDAY) % 7) * 24 + hour % 24
+        return interval, hour_of_week, seconds
+
+    def utilisation(
+        self, date_start: datetime.date, date_stop: datetime.date, by: str = "room", rooms: dict | None = None
+    ) -> dict:
+        bookings, coverage = self._select(date_start, date_stop)
+        groups, group_of_room = self._group_rooms(by, rooms)
+
+        room, start, end = self._merge(bookings["room"], bookings["start"], bookings["end"])
+        interval, hour_of_week, seconds = self._hours_of_week(start, end)
+        group = group_of_room[room[interval]] if len(interval) else np.empty(0, dtype=np.int64)
+        busy = np.bincount(
+            group * HOURS_PER_WEEK + hour_of_week, weights=seconds, minlength=len(groups) * HOURS_PER_WEEK
+        ).reshape(len(groups), HOURS_PER_WEEK)
+
+        # available time: every hour of every day we have seen the room's agenda for; days we know nothing about
+        # don't count as idle
+        covered_group = group_of_room[coverage["room"]] if len(coverage["room"]) else np.empty(0, dtype=np.int64)
+        weekday = (coverage["day"].astype(np.int64) + EPOCH_WEEKDAY) % 7
+        days = np.bincount(covered_group * 7 + weekday, minlength=len(groups) * 7).reshape(len(groups), 7)
+        available = np.repeat(days, 24, axis=1) * HOUR
+        rooms_per_group = np.bincount(group_of_room, minlength=len(groups))
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = np.where(available > 0, busy / available, 0.0)
+            overall = np.where(available.sum(axis=1) > 0, busy.sum(axis=1) / available.sum(axis=1), 0.0)
+
+        return {
+            label: {
+                "rooms": int(rooms_per_group[i]),
+                "overall": round(float(overall[i]), 4),
+                "hour_of_week": [round(float(x), 4) for x in ratio[i]],
+            }
+            for i, label in enumerate(groups)
+        }
+
+    # A booking counts as a no-show when the room declined it, or when it had invitees and none of them accepted
+    # (or tentatively accepted) it.
+    def no_shows(
+        self, date_start: datetime.date, date_stop: datetime.date, by: str = "room", rooms: dict | None = None
+    ) -> dict:
+        bookings, _ = self._select(date_start, date_stop)
+        groups, group_of_room = self._group_rooms(by, rooms)
+
+        no_show = bookings["room_declined"] | (
+            (bookings["invitees"] > 0) & (bookings["accepted"] == 0)
+        )
+        group = group_of_room[bookings["room"]] if len(bookings["room"]) else np.empty(0, dtype=np.int64)
+        total = np.bincount(group, minlength=len(groups))
+        missed = np.bincount(group, weights=no_show, minlength=len(groups))
+
+        return {
+            label: {
+                "bookings": int(total[i]),
+                "no_shows": int(missed[i]),
+                "rate": round(float(missed[i] / total[i]), 4) if total[i] else None,
+            }
+            for i, label in enumerate(groups)
+        }
@@ -0,0 +1,111 @@
+import datetime
+
+import pytz
+from exchangelib import CalendarItem, EWSDate, EWSDateTime, EWSTimeZone
+from exchangelib.recurrence import DailyPattern, DeletedOccurrence, Occurrence, Recurrence, WeeklyPattern
+
+from surfagenda import recurrence
+
+TZ = pytz.timezone("Europe/Amsterdam")
+UTC = EWSTimeZone("UTC")
+
+
+def day(year, month, d):
+    start = TZ.localize(datetime.datetime(year, month, d))
+    return start, start + datetime.timedelta(days=1)
+
+
+def test_daily():
+    master = CalendarItem(
+        start=EWSDateTime(2026, 10, 1, 8, tzinfo=UTC),
+        end=EWSDateTime(2026, 10, 1, 9, tzinfo=UTC),
+        recurrence=Recurrence(pattern=DailyPattern(interval=1), start=datetime.date(2026, 10, 1), number=30),
+    )
+    occurrences = list(recurrence.expand(master, *day(2026, 10, 19), TZ))
+    assert occurrences == [
+        (TZ.localize(datetime.datetime(2026, 10, 19, 10)), TZ.localize(datetime.datetime(2026, 10, 19, 11)))
+    ]
+
+
+def test_numbered_boundary():
+    master = CalendarItem(
+        start=EWSDateTime(2026, 10, 1, 8, tzinfo=UTC),
+        end=EWSDateTime(2026, 10, 1, 9, tzinfo=UTC),
+        recurrence=Recurrence(pattern=DailyPattern(interval=1), start=datetime.date(2026, 10, 1), number=5),
+    )
+    assert list(recurrence.expand(master, *day(2026, 10, 19), TZ)) == []
+
+
+def test_all_day():
+    # exchangelib returns the end date of all-day items inclusive
+    master = CalendarItem(
+        start=EWSDate(2026, 10, 1),
+        end=EWSDate(2026, 10, 1),
+        is_all_day=True,
+        recurrence=Recurrence(pattern=DailyPattern(interval=1), start=datetime.date(2026, 10, 1), number=30),
+    )
+    start, _ = day(2026, 10, 19)
+    assert list(recurrence.expand(master, *day(2026, 10, 19), TZ)) == [(start, start)]
+
+
+def test_all_day_multiple_days():
+    master = CalendarItem(
+        start=EWSDate(2026, 10, 5),
+        end=EWSDate(2026, 10, 6),
+        is_all_day=True,
+        recurrence=Recurrence(
+            pattern=WeeklyPattern(interval=1, weekdays=[1], first_day_of_week=1), start=datetime.date(2026, 10, 5)
+        ),
+    )
+    # the second day of the occurrence that started on Monday
+    start, _ = day(2026, 10, 19)
+    end, _ = day(2026, 10, 20)
+    assert list(recurrence.expand(master, *day(2026, 10, 20), TZ)) == [(start, end)]
+    assert list(recurrence.expand(master, *day(2026, 10, 21), TZ)) == []
+
+
+def test_deleted_and_modified_occurrences():
+    master = CalendarItem(
+        start=EWSDateTime(2026, 10, 1, 8, tzinfo=UTC),
+        end=EWSDateTime(2026, 10, 1, 9, tzinfo=UTC),
+        recurrence=Recurrence(pattern=DailyPattern(interval=1), start=datetime.date(2026, 10, 1)),
+        deleted_occurrences=[DeletedOccurrence(start=EWSDateTime(2026, 10, 19, 8, tzinfo=UTC))],
+        modified_occurrences=[
+            Occurrence(id="moved", original_start=EWSDateTime(2026, 10, 20, 8, tzinfo=UTC)),
+            Occurrence(id="unknown", original_start=EWSDateTime(2026, 10, 21, 8, tzinfo=UTC)),
+        ],
+    )
+    # the occurrence of the 20th was moved to the 22nd
+    exception = CalendarItem(
+        start=EWSDateTime(2026, 10, 22, 12, tzinfo=UTC),
+        end=EWSDateTime(2026, 10, 22, 13, tzinfo=UTC),
+    )
+    exceptions = {"moved": exception}
+
+    window_start, _ = day(2026, 10, 19)
+    _, window_stop = day(2026, 10, 20)
+    assert list(recurrence.occurrences(master, exceptions, window_start, window_stop, TZ)) == []
+
+    window_start, window_stop = day(2026, 10, 22)
+    assert list(recurrence.occurrences(master, exceptions, window_start, window_stop, TZ)) == [
+        (master, TZ.localize(datetime.datetime(2026, 10, 22, 10)), TZ.localize(datetime.datetime(2026, 10, 22, 11))),
+        (exception, None, None),
+    ]
+
+
+def test_all_day_exception():
+    master = CalendarItem(
+        start=EWSDate(2026, 10, 1),
+        end=EWSDate(2026, 10, 1),
+        is_all_day=True,
+        recurrence=Recurrence(pattern=DailyPattern(interval=1), start=datetime.date(2026, 10, 1)),
+        modified_occurrences=[Occurrence(id="moved", original_start=EWSDateTime(2026, 10, 18, 22, tzinfo=UTC))],
+    )
+    exception = CalendarItem(start=EWSDate(2026, 10, 25), end=EWSDate(2026, 10, 25), is_all_day=True)
+
+    window_start, window_stop = day(2026, 10, 25)
+    occurrences = list(recurrence.occurrences(master, {"moved": exception}, window_start, window_stop, TZ))
+    assert occurrences == [(master, window_start, window_start), (exception, None, None)]
+    # the modified occurrence is no longer on its original day
+    window_start, window_stop = day(2026, 10, 19)
+    assert list(recurrence.occurrences(master, {"moved": exception}, window_start, window_stop, TZ)) == []
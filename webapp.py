@@ -2,14 +2,22 @@
 
 import flask
 import surfagenda
+import assets
 #import exchangelib
 import exchangelib.errors
 import json
 import configparser
 import base64
+import datetime
+import functools
+import hashlib
+import hmac
 import logging
-from flask.logging import default_handler
-from pprint import pprint
+import os
+import threading
+import zlib
+from collections import OrderedDict
+import jinja2
 
 log_root = logging.getLogger()
 log_root.setLevel(logging.DEBUG)
@@ -31,46 +39,213 @@ def read_config():
         raise Exception("Invalid config file: missing options")
     return config._sections['config']
 
-app = flask.Flask(__name__)
+def read_profiling_config():
+    config = configparser.ConfigParser()
+    config.read('webapp.config')
+    if not config.has_section('profiling'):
+        return None
+    if not config.get('profiling', 'token', fallback=None):
+        raise Exception("Invalid config file: profiling needs a token")
+    return config._sections['profiling']
+
+# static files are served by the asset pipeline only
+app = flask.Flask(__name__, static_folder=None)
+# keep compiled templates around between restarts; needs to be set before anything touches app.jinja_env
+app.jinja_options = dict(app.jinja_options, bytecode_cache=jinja2.FileSystemBytecodeCache())
+asset_pipeline = assets.AssetPipeline(app, directory=os.path.join(app.root_path, 'static'))
 config = read_config()
 exchange = surfagenda.SurfAgenda(**config)
+ics_feeds = surfagenda.IcsFeedCache(exchange)
+
+# Profiling is opt-in: without a [profiling] section nothing is instrumented and no hooks are installed.
+# Requests are profiled for a fraction (sample_rate) of requests, or when they carry the profiling token in the
+# X-Profile header; the aggregated results are available at /metrics/profile with the same token.
+profiling_config = read_profiling_config()
+profiler = None
+if profiling_config is not None:
+    from surfagenda.profiling import Profiler
+    profiler = Profiler(sample_rate=profiling_config.get('sample_rate', 0),
+        trace_memory=surfagenda.surfagenda._as_bool(profiling_config.get('tracemalloc', False)))
+    profiler.instrument(exchange)
+
+    def profiling_token_ok(token):
+        return token is not None and hmac.compare_digest(token, profiling_config['token'])
+
+    @app.before_request
+    def start_profile():
+        force = profiling_token_ok(flask.request.headers.get('X-Profile'))
+        flask.g.profile = profiler.start(force=force)
+
+    @app.teardown_request
+    def stop_profile(exc):
+        profiler.stop(flask.g.pop('profile', None), flask.request.endpoint)
 
 def request_wants_json(request):
     best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
     return best == 'application/json' and request.accept_mimetypes[best] > request.accept_mimetypes['text/html']
 
 
+# small LRU cache for rendered pages, keyed on the page and the version of the data it was rendered from
+class PageCache:
+    def __init__(self, size=256):
+        self.size = size
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, page):
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+
+page_cache = PageCache()
+
+
+def cached_response(key, digest, render, mimetype='text/html'):
+    etag = hashlib.sha1(repr((key, digest)).encode('utf-8')).hexdigest()
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        page = page_cache.get((key, digest))
+        if page is None:
+            page = render()
+            page_cache.put((key, digest), page)
+        response = flask.Response(page, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+
+@functools.lru_cache(maxsize=4096)
+def b64(str):
+    return base64.urlsafe_b64encode(str.encode('utf-8')).decode('utf-8').replace('=', '')
+
+
 @app.context_processor
 def utility_processor():
-    def b64(str):
-        return base64.urlsafe_b64encode(str.encode('utf-8')).decode('utf-8').replace('=', '')
-
     return dict(base64=b64)
 
 
 @app.errorhandler(exchangelib.errors.ErrorNonExistentMailbox)
 def handle_bad_request(e):
     if request_wants_json(flask.request):
-        data = {"status": 404, "msg": e.__str__}
-        return flask.Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
+        data = {"status": 404, "msg": str(e)}
+        return flask.Response(json.dumps(data, sort_keys=True, indent=4), status=404, mimetype='application/json')
     return flask.render_template('error_no_email.html', error=e), 404
 
 
+# Exchange (or Graph) is in trouble and we have nothing cached to serve instead; this covers both an open circuit
+# and the failures before it opens
+def handle_upstream_failure(e):
+    if request_wants_json(flask.request):
+        data = {"status": 503, "msg": str(e)}
+        response = flask.Response(json.dumps(data, sort_keys=True, indent=4), status=503, mimetype='application/json')
+    else:
+        response = flask.Response('Exchange is currently unavailable, please try again later.', status=503,
+            mimetype='text/plain')
+    retry_after = getattr(e, 'retry_after', None) or getattr(e, 'back_off', None)
+    if retry_after:
+        response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+for upstream_error in surfagenda.breaker.UPSTREAM_ERRORS:
+    app.register_error_handler(upstream_error, handle_upstream_failure)
+
+
+def mark_stale(response, stale):
+    if stale:
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
+
+
+# ?since=<version> asks for just the changes since that version of the agenda; see SurfAgenda.get_agenda_delta()
+def parse_since():
+    since = flask.request.args.get('since')
+    if since is None:
+        return None
+    try:
+        return int(since)
+    except ValueError:
+        flask.abort(400, 'Invalid version: {}'.format(since))
+
+
+def delta_response(delta):
+    response = flask.Response(json.dumps(delta, sort_keys=True, indent=4, cls=surfagenda.JSONAgendaEncoder),
+        mimetype='application/json')
+    response.headers['X-Agenda-Version'] = str(delta['version'])
+    return mark_stale(response, delta['stale'])
+
+
 @app.route('/agenda/<email>', defaults={'theDate': 'today'})
 @app.route('/agenda/<email>/<theDate>')
 def agenda(email, theDate):
-    global exchange
+    email = exchange.people.resolve(email)
 
-    if not '@' in email:
-        email = '{}@surfnet.nl'.format(email)
+    since = parse_since()
+    if since is not None:
+        return delta_response(exchange.get_agenda_delta(email, theDate, since=since))
 
-    items, realdate = exchange.get_agenda_for_day(email, theDate)
+    # one lookup, so the items, digest and version all belong to the same version of the agenda
+    entry = exchange.get_agenda_entry(email, theDate)
+    items, realdate, digest, stale = entry['data'], entry['date'], entry['digest'], entry['stale']
 
     if request_wants_json(flask.request):
-        return flask.Response(json.dumps(items, sort_keys=True, indent=4, cls=surfagenda.JSONAgendaEncoder),
+        response = cached_response(('agenda.json', email, realdate), digest,
+            lambda: json.dumps(items, sort_keys=True, indent=4, cls=surfagenda.JSONAgendaEncoder),
             mimetype='application/json')
+        response.headers['X-Agenda-Version'] = str(entry['version'])
+        return mark_stale(response, stale)
+
+    return mark_stale(cached_response(('agenda.html', email, realdate), digest,
+        lambda: flask.render_template('agenda.html', email=email, agenda=items, date=realdate)), stale)
+
+
+def ics_response(feed, filename):
+    if flask.request.if_none_match.contains(feed.etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(flask.stream_with_context(iter(feed)), mimetype='text/calendar')
+        response.headers['Content-Disposition'] = 'inline; filename="{}"'.format(filename)
+    response.set_etag(feed.etag)
+    return mark_stale(response, feed.stale)
+
+
+@app.route('/agenda/<email>.ics')
+def agenda_ics(email):
+    email = exchange.people.resolve(email)
 
-    return flask.render_template('agenda.html', email=email, agenda=items, date=realdate)
+    return ics_response(ics_feeds.get(email), '{}.ics'.format(email))
+
+
+@app.route('/kamer/<number>.ics')
+@app.route('/room/<number>.ics')
+def room_ics(number):
+    rooms = exchange.get_rooms()
+    if number not in rooms:
+        flask.abort(404)
+
+    return ics_response(ics_feeds.get(rooms[number]['email']), '{}.ics'.format(number))
+
+
+@app.route('/kamer/<number>/agenda')
+@app.route('/room/<number>/agenda')
+def room_agenda(number):
+    rooms = exchange.get_rooms()
+    if number not in rooms:
+        flask.abort(404)
+
+    since = parse_since()
+    return delta_response(exchange.get_agenda_delta(rooms[number]['email'], flask.request.args.get('date', 'today'),
+        since=since))
 
 
 @app.route('/kamer/')
@@ -78,44 +253,159 @@ def agenda(email, theDate):
 @app.route('/room/')
 @app.route('/room')
 def all_rooms():
-    global exchange
-    rooms = exchange.get_rooms()
+    entry = exchange.get_rooms_entry()
+    rooms, digest, stale = entry['data'], entry['digest'], entry['stale']
 
     # todo: bezet tot
 
+    # optional filters, e.g. /room?floor=4&min_people=8; repeat a parameter to match any of its values
+    args = flask.request.args
+    query = dict()
+    try:
+        for name, convert in (('floor', int), ('location', str), ('type', str), ('group', str)):
+            if name in args:
+                query[name] = [convert(value) for value in args.getlist(name)]
+        for name in ('min_people', 'max_people'):
+            if name in args:
+                query[name] = int(args[name])
+    except ValueError as e:
+        flask.abort(400, 'Invalid room filter: {}'.format(e))
+    query_key = tuple(sorted((name, repr(value)) for name, value in query.items()))
+
     if request_wants_json(flask.request):
-        return flask.Response(json.dumps(rooms, sort_keys=True, indent=4), mimetype='application/json')
+        def render_json():
+            if not query:
+                return json.dumps(rooms, sort_keys=True, indent=4)
+            return json.dumps({room['number']: room for room in rooms.query(**query)}, sort_keys=True, indent=4)
+        return mark_stale(cached_response(('rooms.json', query_key), digest, render_json,
+            mimetype='application/json'), stale)
 
-    kamers = sorted(rooms.values(), key=lambda x: '{floor}.{floor_subnum:02d}'.format(**x))
+    def render():
+        return flask.render_template('kamers.html', kamers=rooms.query(**query))
 
-    return flask.render_template('kamers.html', kamers=kamers)
+    return mark_stale(cached_response(('kamers.html', query_key), digest, render), stale)
 
 
+# Streams the agendas of all rooms, each room as soon as it is available. By default this is a JSON object of room
+# number to [agenda, date]; with ?format=ndjson (or Accept: application/x-ndjson) it is one JSON object per line.
+# Rooms whose agenda could not be fetched get an error instead. Compressed with gzip if the client accepts it;
+# every room is flushed separately, so clients can start rendering right away.
 @app.route('/kamer/alles/agenda')
 @app.route('/room/all/agenda')
 def all_room_agenda():
-    global exchange
-    agendas = exchange.get_rooms_agendas()
-    return flask.Response(json.dumps(agendas, sort_keys=True, indent=4, cls=surfagenda.JSONAgendaEncoder),
+    request = flask.request
+    ndjson = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+    # parse the date and fetch the room list before the response starts, so their errors get a proper status
+    try:
+        results = exchange.iter_rooms_agendas(date=request.args.get('date', 'today'))
+    except (ValueError, OverflowError) as e:
+        flask.abort(400, 'Invalid date: {}'.format(e))
+
+    def dumps(data):
+        return json.dumps(data, sort_keys=True, cls=surfagenda.JSONAgendaEncoder)
+
+    def generate_ndjson():
+        for room, agenda, error in results:
+            line = {'room': room['number'], 'email': room['email']}
+            if error is None:
+                line['agenda'], line['date'] = agenda
+            else:
+                line['error'] = '{}: {}'.format(type(error).__name__, error)
+            yield dumps(line) + '\n'
+
+    def generate_json():
+        separator = '{\n'
+        for room, agenda, error in results:
+            value = agenda if error is None else {'error': '{}: {}'.format(type(error).__name__, error)}
+            yield '{}{}: {}'.format(separator, dumps(room['number']), dumps(value))
+            separator = ',\n'
+        yield '{}}}\n'.format('{' if separator == '{\n' else '\n')
+
+    def gzipped(chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    chunks = generate_ndjson() if ndjson else generate_json()
+    use_gzip = 'gzip' in request.accept_encodings
+    if use_gzip:
+        chunks = gzipped(chunks)
+
+    response = flask.Response(flask.stream_with_context(chunks),
+        mimetype='application/x-ndjson' if ndjson else 'application/json')
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.route('/kamer/bezetting')
+@app.route('/room/utilisation')
+def room_utilisation():
+    if exchange.utilisation is None:
+        flask.abort(404)
+    args = flask.request.args
+    try:
+        stop = exchange._parse_date(args.get('stop', 'today'))
+        start = exchange._parse_date(args['start']) if 'start' in args else stop - datetime.timedelta(weeks=4)
+        data = exchange.get_utilisation(start, stop, by=args.get('by', 'room'))
+    except (ValueError, OverflowError) as e:
+        flask.abort(400, str(e))
+    return flask.Response(json.dumps(data, sort_keys=True, indent=4, cls=surfagenda.JSONAgendaEncoder),
         mimetype='application/json')
 
 
 @app.route('/issievrij/<email>')
 @app.route('/available/<email>')
 def availability(email):
-    global exchange
-    if not '@' in email:
-        email = '{}@surfnet.nl'.format(email)
+    email = exchange.people.resolve(email)
 
     data = exchange.get_availability(email)
 
     if request_wants_json(flask.request):
-        return flask.Response(json.dumps(data, sort_keys=True, indent=4, cls=surfagenda.JSONAgendaEncoder),
-            mimetype='application/json')
+        return mark_stale(flask.Response(json.dumps(data, sort_keys=True, indent=4, cls=surfagenda.JSONAgendaEncoder),
+            mimetype='application/json'), data.get('stale', False))
 
     return ""
 
 
+# autocomplete for names and email addresses
+@app.route('/people')
+def people():
+    try:
+        limit = min(int(flask.request.args.get('limit', 10)), 100)
+    except ValueError:
+        flask.abort(400)
+    data = exchange.people.search(flask.request.args.get('q', ''), limit=limit)
+    return flask.Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
+
+
+@app.route('/metrics/scheduler')
+def scheduler_metrics():
+    return flask.Response(json.dumps(exchange.scheduler_stats(), sort_keys=True, indent=4),
+        mimetype='application/json')
+
+
+@app.route('/metrics/breakers')
+def breaker_metrics():
+    data = {name: breaker.stats() for name, breaker in exchange.breakers.items()}
+    return flask.Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
+
+
+@app.route('/metrics/profile', methods=['GET', 'DELETE'])
+def profile_metrics():
+    auth = flask.request.authorization
+    if profiler is None or not profiling_token_ok(auth.token if auth is not None else None):
+        flask.abort(404)
+    if flask.request.method == 'DELETE':
+        profiler.reset()
+        return flask.Response(status=204)
+    return flask.Response(json.dumps(profiler.stats(exchange), sort_keys=True, indent=4),
+        mimetype='application/json')
+
+
 if __name__ == '__main__':
     app.debug = True
     app.run()